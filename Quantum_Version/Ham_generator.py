@@ -1,114 +1,351 @@
 from qiskit import QuantumCircuit
-from qiskit.quantum_info import Pauli, Operator
+from qiskit.quantum_info import Pauli, Operator, SparsePauliOp
 from qcels import ham_shift as scale_factor
 from qiskit_nature.second_q.drivers import PySCFDriver
 from qiskit_nature.second_q.mappers import ParityMapper
 from qiskit_nature.units import DistanceUnit
 import numpy as np
-from numpy.linalg import eigh
+import scipy.sparse
 import subprocess
 import os
+import hashlib
+import tempfile
+import functools
+import math
+import qiskit
+import spectrum
+import tfim_free_fermion
+from cache_utils import atomic_write
 
-def generate_TFIM_gates(qubits, steps, dt, g, scaling, location, trotter = 1):
+_paulis = {'I': np.eye(2), 'X': np.array([[0, 1], [1, 0]]), 'Y': np.array([[0, -1j], [1j, 0]]), 'Z': np.diag([1, -1])}
+
+def local_terms(qubits, factors, coeff=1):
+    """
+    Description: Expand coeff times a tensor product of single-site operators into Pauli terms
+
+    Args: number of qubits: qubits; {site: 2x2 matrix} (site 0 is the leftmost tensor factor): factors;
+    overall coefficient: coeff
+
+    Returns: list of (label, coefficient) pairs
+    """
+    terms = [('', coeff)]
+    for site in range(qubits):
+        M = factors.get(site, _paulis['I'])
+        local = [(P, np.trace(_paulis[P] @ M)/2) for P in 'IXYZ']
+        terms = [(label + P, c*cP) for label, c in terms for P, cP in local if cP != 0]
+    return terms
+
+def pauli_terms_to_csr(terms, qubits):
+    """
+    Description: Build a CSR matrix from Pauli terms with bit operations, without forming
+    any dense 2^n x 2^n matrix. A Pauli string maps |i> to i^ny (-1)^popcount(i & zmask) |i ^ xmask>,
+    where xmask (zmask) marks the X/Y (Z/Y) sites and ny counts the Y factors.
+
+    Args: list of (label, coefficient) pairs: terms; number of qubits: qubits
+
+    Returns: scipy.sparse.csr_matrix of shape (2^n, 2^n)
+    """
+    n = 2**qubits
+    idx = np.arange(n, dtype=np.int64)
+    columns = {}
+    for label, coeff in terms:
+        xmask = zmask = ny = 0
+        for pos, P in enumerate(label):
+            bit = 1 << (qubits - 1 - pos)
+            if P in 'XY': xmask |= bit
+            if P in 'ZY': zmask |= bit
+            if P == 'Y': ny += 1
+        parity = np.zeros(n, dtype=np.int64)
+        for k in range(qubits):
+            if zmask >> k & 1: parity ^= (idx >> k) & 1
+        values = coeff*(1j)**ny*(1 - 2*parity)
+        if xmask in columns:
+            columns[xmask] += values
+        else:
+            columns[xmask] = values.astype(np.complex128)
+    rows = np.concatenate([idx ^ xmask for xmask in columns])
+    cols = np.concatenate([idx for _ in columns])
+    data = np.concatenate(list(columns.values()))
+    H = scipy.sparse.csr_matrix((data, (rows, cols)), shape=(n, n))
+    H.eliminate_zeros()
+    return H
+
+def hamiltonian_terms(qubits, system, g=0, J=4, t=0, U=0, x=1, y=1):
+    """
+    Description: Pauli decomposition of the unscaled Hamiltonians of create_hamiltonian
+
+    Args: same as create_hamiltonian
+
+    Returns: list of (label, coefficient) pairs
+    """
+    terms = []
+    if system[0:4].upper() == "TFIM":
+        for i in range(qubits-1):
+            terms += local_terms(qubits, {i: _paulis['Z'], i+1: _paulis['Z']}, -1)
+        for i in range(qubits):
+            terms += local_terms(qubits, {i: _paulis['X']}, -g)
+    elif system[0:4].upper() == "SPIN":
+        assert(J!=0)
+        bonds = [(qubit, qubit+1) for qubit in range(qubits-1)] + [(qubits-1, 0)]
+        for a, b in bonds:
+            for P in 'XYZ':
+                if a == b:
+                    terms += local_terms(qubits, {a: _paulis[P] @ _paulis[P]}, J/4)
+                else:
+                    terms += local_terms(qubits, {a: _paulis[P], b: _paulis[P]}, J/4)
+    elif system[0:4].upper() == "HUBB":
+        assert(x>=0 and y>=0)
+        assert(x*y == qubits)
+        Sd = np.array([[0,0],[1,0]])
+        S = np.array([[0,1],[0,0]])
+        for site in range(qubits):
+            curr_x = site%x
+            curr_y = site//x%y
+            neighbors = []
+            if curr_x != 0:   neighbors.append((site-1)%qubits)
+            if curr_x != x-1: neighbors.append((site+1)%qubits)
+            if curr_y != 0:   neighbors.append((site+x)%qubits)
+            if curr_y != y-1: neighbors.append((site-x)%qubits)
+            for neighbor in neighbors:
+                terms += local_terms(qubits, {site: Sd, neighbor: S}, -t)
+        for place in range(qubits-1):
+            terms += local_terms(qubits, {place: Sd @ S, place+1: Sd @ S}, U)
+    elif system[0:4].upper() == "H2":
+        terms = h2_operator().to_list()
+    return terms
+
+def h2_operator():
+    driver = PySCFDriver(
+        atom=f'H .0 .0 .0; H .0 .0 {0.5}',
+        unit=DistanceUnit.ANGSTROM,
+        basis='sto3g'
+    )
+
+    molecule = driver.run()
+    mapper = ParityMapper(num_particles=molecule.num_particles)
+    hamiltonian = molecule.hamiltonian.second_q_op()
+    tapered_mapper = molecule.get_tapered_mapper(mapper)
+    return tapered_mapper.map(hamiltonian)
+
+def terms_to_output(terms, qubits, output):
+    """ Convert Pauli terms to a SparsePauliOp ('pauli') or a CSR matrix ('csr') """
+    if output[0].upper() == 'P':
+        return SparsePauliOp.from_list(terms).simplify()
+    return pauli_terms_to_csr(terms, qubits)
+
+def generate_TFIM_gates(qubits, steps, dt, g, scaling, location, trotter = 1, output = 'csr', memo_dir = 'TFIM_Gates'):
     exe = location+"/release/examples/f3c_time_evolution_TFYZ"
     
-    # calculate new scaled parameters
-    H = np.zeros((2**qubits, 2**qubits), dtype=np.complex128)
-    for i in range(qubits-1):
-        temp = Pauli('')
-        for j in range(qubits):
-            if (j == i or j == i+1):
-                temp ^= Pauli('Z')
-            else:
-                temp ^= Pauli('I')
-        H += -temp.to_matrix()
-    for i in range(qubits):
-        temp = Pauli('')
-        for j in range(qubits):
-            if (j == i):
-                temp ^= Pauli('X')
-            else:
-                temp ^= Pauli('I')
-        H += -g*temp.to_matrix()
-    n = 2**qubits
+    if output[0].upper() != 'D':
+        # calculate new scaled parameters from the sparse Hamiltonian
+        terms = hamiltonian_terms(qubits, 'TFIM', g=g)
+        largest_eig = tfim_free_fermion.largest_eigenvalue(qubits, 1, g)
+        coupling = scaling/largest_eig
+        g *= scaling/largest_eig
+
+        # calculate scaled Hamiltonian
+        H = terms_to_output([(label, coupling*c) for label, c in terms], qubits, output)
+    else:
+        # calculate new scaled parameters
+        H = np.zeros((2**qubits, 2**qubits), dtype=np.complex128)
+        for i in range(qubits-1):
+            temp = Pauli('')
+            for j in range(qubits):
+                if (j == i or j == i+1):
+                    temp ^= Pauli('Z')
+                else:
+                    temp ^= Pauli('I')
+            H += -temp.to_matrix()
+        for i in range(qubits):
+            temp = Pauli('')
+            for j in range(qubits):
+                if (j == i):
+                    temp ^= Pauli('X')
+                else:
+                    temp ^= Pauli('I')
+            H += -g*temp.to_matrix()
+        n = 2**qubits
+
+        largest_eig = spectrum.largest_eigenvalue(H)
+        coupling = scaling/largest_eig
+        g *= scaling/largest_eig
 
-    eigs, _ = eigh(H)
-    largest_eig = eigs[-1]
-    coupling = scaling/largest_eig
-    g *= scaling/largest_eig
-
-    # calculate scaled Hamiltonian
-    H = np.zeros((n, n), dtype=np.complex128)
-    for i in range(qubits-1):
-        temp = Pauli('')
-        for j in range(qubits):
-            if (j == i or j == i+1):
-                temp ^= Pauli('Z')
-            else:
-                temp ^= Pauli('I')
-        H += -coupling*temp.to_matrix()
-    for i in range(qubits):
-        temp = Pauli('')
-        for j in range(qubits):
-            if (j == i):
-                temp ^= Pauli('X')
-            else:
-                temp ^= Pauli('I')
-        H += -g*temp.to_matrix()
+        # calculate scaled Hamiltonian
+        H = np.zeros((n, n), dtype=np.complex128)
+        for i in range(qubits-1):
+            temp = Pauli('')
+            for j in range(qubits):
+                if (j == i or j == i+1):
+                    temp ^= Pauli('Z')
+                else:
+                    temp ^= Pauli('I')
+            H += -coupling*temp.to_matrix()
+        for i in range(qubits):
+            temp = Pauli('')
+            for j in range(qubits):
+                if (j == i):
+                    temp ^= Pauli('X')
+                else:
+                    temp ^= Pauli('I')
+            H += -g*temp.to_matrix()
 
     # make negative exponential
     g = -g
     coupling = -coupling
-    
-    gates = []
-    if not os.path.exists("TFIM_Operators"):
-        os.mkdir("TFIM_Operators")
-    
+
     # add timestep where dt = 0
-    with open("TFIM_Operators/Operator_Generator.ini", 'w+') as f:
-        f.write("[Qubits]\nnumber = "+str(qubits)+"\n\n")
-        f.write("[Trotter]\nsteps = 1\ndt = 0\n\n") # maybe need new number for steps
-        f.write("[Jy]\nvalue = 0\n\n")
-        f.write("[Jz]\nvalue = "+str(coupling)+"\n\n")
-        f.write("[hx]\nramp = constant\nvalue = "+str(g)+"\n\n")
-        f.write("[Output]\nname = TFIM_Operators/n="+str(qubits)+"_g="+str(g)+"_dt="+str(dt)+"_i=\nimin = 1\nimax = 2\nstep = 1\n")
-    exe = location+"/release/examples/f3c_time_evolution_TFYZ"
-    with open("TFIM_Operators/garbage.txt", "w") as file:
-        subprocess.run([exe, "TFIM_Operators/Operator_Generator.ini"], stdout=file)
-    os.remove("TFIM_Operators/garbage.txt")
-    os.remove("TFIM_Operators/Operator_Generator.ini")
-    qc = QuantumCircuit.from_qasm_file("TFIM_Operators/n="+str(qubits)+"_g="+str(g)+"_dt="+str(dt)+"_i=1.qasm")
-    gate = qc.to_gate(label = "TFIM 0").control()
-    gates.append(gate)
-    os.remove("TFIM_Operators/n="+str(qubits)+"_g="+str(g)+"_dt="+str(dt)+"_i=1.qasm")
+    gate = tfim_step_gates(exe, qubits, coupling, g, 0, 1, [1], memo_dir)[0]
+    gate.label = "TFIM 0"
+    gates = [gate.control()]
     steps -= 1
     steps *= trotter
     dt /= trotter
 
-    with open("TFIM_Operators/Operator_Generator.ini", 'w+') as f:
-        f.write("[Qubits]\nnumber = "+str(qubits)+"\n\n")
-        f.write("[Trotter]\nsteps = "+str(steps)+"\ndt = "+str(dt)+"\n\n") # maybe need new number for steps
-        f.write("[Jy]\nvalue = 0\n\n")
-        f.write("[Jz]\nvalue = "+str(coupling)+"\n\n")
-        f.write("[hx]\nramp = constant\nvalue = "+str(g)+"\n\n")
-        f.write("[Output]\nname = TFIM_Operators/n="+str(qubits)+"_g="+str(g)+"_dt="+str(dt)+"_i=\nimin = 1\nimax = "+str(steps+1)+"\nstep = "+str(1)+"\n")
-    exe = location+"/release/examples/f3c_time_evolution_TFYZ"
-    with open("TFIM_Operators/garbage.txt", "w") as file:
-        subprocess.run([exe, "TFIM_Operators/Operator_Generator.ini"], stdout=file)
-    os.remove("TFIM_Operators/garbage.txt")
-    os.remove("TFIM_Operators/Operator_Generator.ini")
-    for step in range(1, steps + 1):
-        if step%trotter == 0:
-            qc = QuantumCircuit.from_qasm_file("TFIM_Operators/n="+str(qubits)+"_g="+str(g)+"_dt="+str(dt)+"_i="+str(step)+".qasm")
-            gate = qc.to_gate(label = "TFIM "+str(step)).control()
-            gates.append(gate)
-        os.remove("TFIM_Operators/n="+str(qubits)+"_g="+str(g)+"_dt="+str(dt)+"_i="+str(step)+".qasm")
-    os.rmdir("TFIM_Operators")
+    # only every trotter-th step is a gate of the output
+    gates += [gate.control() for gate in tfim_step_gates(exe, qubits, coupling, g, dt, trotter, range(trotter, steps + 1, trotter), memo_dir)]
     return gates, H
 
-def create_hamiltonian(qubits, system, scale_factor, g=0, J=4, t=0, U=0, x=1, y=1, show_steps=False):
+def _tfim_memo_path(memo_dir, qubits, g, coupling, dt, trotter, step):
+    key = repr((int(qubits), float(g), float(coupling), float(dt), int(trotter), int(step)))
+    return os.path.join(memo_dir, hashlib.sha256(key.encode()).hexdigest() + '.qpy')
+
+def f3c_circuits(exe, qubits, coupling, g, dt, imax, imin = 1, step = 1):
+    """
+    Description: Run f3c_time_evolution_TFYZ in a private temporary directory and yield the
+    compressed circuits of steps imin, imin+step, ..., imax. Concurrent calls never share files.
+
+    Args: path of the f3c executable: exe; number of qubits: qubits;
+    (negated, scaled) ZZ coupling and field: coupling, g; Trotter time step: dt;
+    last, first and stride of the written steps: imax, imin, step
+
+    Returns: generator of (step, QuantumCircuit)
+    """
+    with tempfile.TemporaryDirectory(prefix = "TFIM_Operators_") as tmp:
+        ini = os.path.join(tmp, "Operator_Generator.ini")
+        name = os.path.join(tmp, "i=")
+        with open(ini, 'w') as f:
+            f.write("[Qubits]\nnumber = "+str(qubits)+"\n\n")
+            f.write("[Trotter]\nsteps = "+str(imax)+"\ndt = "+str(dt)+"\n\n")
+            f.write("[Jy]\nvalue = 0\n\n")
+            f.write("[Jz]\nvalue = "+str(coupling)+"\n\n")
+            f.write("[hx]\nramp = constant\nvalue = "+str(g)+"\n\n")
+            f.write("[Output]\nname = "+name+"\nimin = "+str(imin)+"\nimax = "+str(imax+1)+"\nstep = "+str(step)+"\n")
+        subprocess.run([exe, ini], stdout = subprocess.DEVNULL, check = True)
+        for i in range(imin, imax + 1, step):
+            with open(name+str(i)+".qasm", 'r') as f:
+                yield i, QuantumCircuit.from_qasm_str(f.read())
+
+def tfim_step_gates(exe, qubits, coupling, g, dt, trotter, steps, memo_dir = 'TFIM_Gates'):
+    """
+    Description: Uncontrolled TFIM evolution gates after the given Trotter steps, memoized on disk
+    under (qubits, g, coupling, dt, trotter, step). Only missing steps are generated.
+
+    Args: path of the f3c executable: exe; number of qubits: qubits;
+    (negated, scaled) ZZ coupling and field: coupling, g; Trotter time step: dt;
+    Trotter steps per output time step: trotter; increasing list of steps: steps;
+    memo directory (None disables the memo): memo_dir
+
+    Returns: list of gates labeled "TFIM <step>"
+    """
+    steps = list(steps)
+    circuits = {}
+    if memo_dir is not None:
+        os.makedirs(memo_dir, exist_ok = True)
+        for step in steps:
+            path = _tfim_memo_path(memo_dir, qubits, g, coupling, dt, trotter, step)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    circuits[step] = qiskit.qpy.load(f)[0]
+    missing = [step for step in steps if step not in circuits]
+    if missing:
+        # the executable has to evolve through every step anyway; write only the ones we need
+        stride = functools.reduce(math.gcd, missing)
+        wanted = set(missing)
+        for step, qc in f3c_circuits(exe, qubits, coupling, g, dt, max(missing), imin = stride, step = stride):
+            if step not in wanted:
+                continue
+            circuits[step] = qc
+            if memo_dir is not None:
+                # parallel writers cannot clash
+                with atomic_write(_tfim_memo_path(memo_dir, qubits, g, coupling, dt, trotter, step)) as f:
+                    qiskit.qpy.dump(qc, f)
+    return [circuits[step].to_gate(label = "TFIM "+str(step)) for step in steps]
+
+class TFIMGateProvider:
+    """
+    Description: Controlled TFIM evolution gates for the taus of the multi-level schedule.
+    get_tau repeats the same taus across trials, so every distinct (tau, time_steps) is
+    generated once, on its own grid with Trotter step dt = tau/trotter, and reused. Gates are
+    only shared between requests whose grids (dt and step) match exactly.
+
+    Args: number of qubits: qubits; transverse field: g; rescaled norm: scaling;
+    f3cpp directory: location; Trotter steps per tau: trotter;
+    memo directory of tfim_step_gates: memo_dir
+    """
+
+    def __init__(self, qubits, g, scaling, location, trotter = 1, memo_dir = 'TFIM_Gates'):
+        self.qubits = qubits
+        self.trotter = trotter
+        self.memo_dir = memo_dir
+        self.exe = location+"/release/examples/f3c_time_evolution_TFYZ"
+        largest_eig = tfim_free_fermion.largest_eigenvalue(qubits, 1, g)
+        # negative exponential of the scaled parameters, as in generate_TFIM_gates
+        self.coupling = -scaling/largest_eig
+        self.g = -g*scaling/largest_eig
+        self.grids = {} # Trotter step dt -> {step: controlled gate}
+        self.memo = {} # (tau, time_steps) -> list of controlled gates
+        self.identity = None
+
+    def _identity(self):
+        if self.identity is None:
+            gate = tfim_step_gates(self.exe, self.qubits, self.coupling, self.g, 0, 1, [1], self.memo_dir)[0]
+            gate.label = "TFIM 0"
+            self.identity = gate.control()
+        return self.identity
+
+    def gates(self, taus, time_steps):
+        """
+        Description: Gates exp(-iH k tau) for k = 0, ..., time_steps-1 and every tau
+
+        Args: time steps (duplicates are served once): taus; number of data pairs: time_steps
+
+        Returns: {tau: list of controlled gates}
+        """
+        gates = {}
+        for tau in sorted(set(float(tau) for tau in taus)):
+            if (tau, time_steps) not in self.memo:
+                # same grid as generate_TFIM_gates: (time_steps-1)*trotter steps of tau/trotter
+                dt = tau/self.trotter
+                grid = self.grids.setdefault(dt, {})
+                steps = [k*self.trotter for k in range(1, time_steps)]
+                missing = [step for step in steps if step not in grid]
+                if missing:
+                    for step, gate in zip(missing, tfim_step_gates(self.exe, self.qubits, self.coupling, self.g, dt, self.trotter, missing, self.memo_dir)):
+                        grid[step] = gate.control()
+                self.memo[(tau, time_steps)] = [self._identity()] + [grid[step] for step in steps]
+            gates[tau] = self.memo[(tau, time_steps)]
+        return gates
+
+def create_hamiltonian(qubits, system, scale_factor, g=0, J=4, t=0, U=0, x=1, y=1, show_steps=False, output='csr', norm='exact'):
     assert(system[0:4].upper() == "TFIM" or system[0:4].upper() == "SPIN" or system[0:4].upper() == "HUBB" or system[0:4].upper() == "H2")
     # assert(abs(scale_factor)<=2*pi)
+    if output[0].upper() != 'D':
+        # SparsePauliOp ('pauli') or scipy CSR ('csr') without any dense 2^n x 2^n matrix;
+        # the dense matrix of the branches below is only built for output = 'dense'
+        terms = hamiltonian_terms(qubits, system, g=g, J=J, t=t, U=U, x=x, y=y)
+        if system[0:4].upper() == "H2":
+            qubits = SparsePauliOp.from_list(terms).num_qubits
+        if show_steps: print("H =", " ".join(str(c)+"*"+label for label, c in terms))
+        # built once, normalized on itself and rescaled in place
+        H = terms_to_output(terms, qubits, output)
+        if norm[0].upper() == 'P':
+            H_norm = spectrum.spectral_norm(terms, method=norm)
+        else:
+            H_norm = spectrum.spectral_norm(H, method='lanczos')
+        if show_steps: print("Norm =", H_norm)
+        H *= scale_factor/H_norm
+        return H
+
     H = np.zeros((2**qubits, 2**qubits), dtype=np.complex128)
     if system[0:4].upper() == "TFIM":
         # construct the Hamiltonian
@@ -203,18 +440,7 @@ def create_hamiltonian(qubits, system, scale_factor, g=0, J=4, t=0, U=0, x=1, y=
         H = up_down_hopping_term+left_right_hopping_term
 
     elif system[0:4].upper() == "H2":
-        driver = PySCFDriver(
-            atom=f'H .0 .0 .0; H .0 .0 {0.5}',
-            unit=DistanceUnit.ANGSTROM,
-            basis='sto3g'
-        )
-
-        molecule = driver.run()
-        mapper = ParityMapper(num_particles=molecule.num_particles)
-        hamiltonian = molecule.hamiltonian.second_q_op()
-        tapered_mapper = molecule.get_tapered_mapper(mapper)
-        operator = tapered_mapper.map(hamiltonian)
-        H = operator.to_matrix()
+        H = h2_operator().to_matrix()
             
     if show_steps:
         val, vec = np.linalg.eigh(H)
@@ -222,8 +448,10 @@ def create_hamiltonian(qubits, system, scale_factor, g=0, J=4, t=0, U=0, x=1, y=
         print("Original eigenvectors:\n", vec)
     
     # scale eigenvalues of the Hamiltonian
-    if show_steps: print("Norm =", np.linalg.norm(H, ord=2))
-    H = scale_factor*H/np.linalg.norm(H, ord=2)
+    # norm = 'exact' (dense 2-norm), 'lanczos' (extremal eigenvalues) or 'pauli' (Pauli 1-norm bound)
+    H_norm = spectrum.spectral_norm(H, method=norm)
+    if show_steps: print("Norm =", H_norm)
+    H = scale_factor*H/H_norm
     # rotate matrix so that it will be positive definite (not nessary in this usecase)
     # H += pi*np.eye(2**qubits)
 
@@ -0,0 +1,97 @@
+""" Walker/Vose alias method for drawing Fourier indices
+
+generate_cdf draws the indices J of every batch from the same |F_coeffs|
+distribution. An AliasSampler builds the alias table once in O(n) and then
+draws each sample in O(1) from a single uniform number: its integer part
+picks a column, its fractional part decides between the column and its
+alias. Samplers are cached by a hash of the measure, and filter_store
+keeps the tables of F_fourier_coeffs(d, delta) on disk next to the filter.
+"""
+import numpy as np
+
+from cache_utils import ContentLRU, content_key
+
+
+class AliasSampler:
+    """
+    Description: Alias table of a discrete distribution proportional to measure
+
+    Args: nonnegative weights: measure (or the precomputed table via prob and alias)
+    """
+
+    def __init__(self, measure = None, prob = None, alias = None):
+        if prob is None:
+            prob, alias = vose_table(np.asarray(measure, dtype=float))
+        self.prob = prob
+        self.alias = alias
+
+    @property
+    def n(self):
+        return self.prob.shape[0]
+
+    def sample(self, Nsample, rng = None, out = None):
+        """
+        Description: Draw Nsample indices
+
+        Args: number of samples: Nsample;
+        np.random.Generator, or None for the global np.random stream: rng;
+        preallocated integer output buffer of length Nsample: out
+
+        Returns: out filled with indices in [0, n)
+        """
+        if out is None:
+            out = np.empty(Nsample, dtype=np.int64)
+        u = np.random.rand(Nsample) if rng is None else rng.random(Nsample)
+        u *= self.n
+        column = u.astype(np.int64)
+        np.minimum(column, self.n - 1, out = column)
+        u -= column # fractional part decides between the column and its alias
+        keep = u < self.prob[column]
+        np.copyto(out, self.alias[column])
+        out[keep] = column[keep]
+        return out
+
+
+def vose_table(measure):
+    """
+    Description: Vose's alias table for weights proportional to measure
+
+    Args: nonnegative weights: measure
+
+    Returns: acceptance probabilities: prob; alias indices: alias
+    """
+    n = measure.shape[0]
+    scaled = measure*(n/np.sum(measure))
+    prob = np.ones(n)
+    alias = np.arange(n, dtype=np.int64)
+    small = list(np.flatnonzero(scaled < 1.0))
+    large = list(np.flatnonzero(scaled >= 1.0))
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] -= 1.0 - scaled[s]
+        (small if scaled[l] < 1.0 else large).append(l)
+    # leftovers are 1 up to rounding
+    for i in small + large:
+        prob[i] = 1.0
+    return prob, alias
+
+
+_samplers = ContentLRU(8)
+
+
+def _key(measure):
+    # integer and float weights of the same values share a sampler
+    return content_key(np.asarray(measure, dtype=float))
+
+
+def register(measure, sampler):
+    """ Put a sampler (e.g. restored from filter_store) into the cache under its measure """
+    return _samplers.put(_key(measure), sampler)
+
+
+def cached(measure):
+    """ AliasSampler for measure, built once and reused for identical measures """
+    return _samplers.get_or_build(_key(measure), lambda: AliasSampler(measure))
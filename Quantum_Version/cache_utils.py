@@ -0,0 +1,89 @@
+""" Shared helpers for in-process caches and on-disk stores
+
+ContentLRU is the least-recently-used map behind the caches keyed by the
+contents of an array (eigendecompositions in signal_engine, alias tables in
+alias_sampler); content_key hashes the shape, dtype and bytes of the array.
+atomic_write is the write-to-a-unique-temporary-file-then-rename pattern of
+every file that other processes or a resumed run may read (memoized TFIM
+circuits, filter coefficients, the circuit cache, run checkpoints): readers
+see either the old or the new file, never a partial one.
+"""
+import contextlib
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def content_key(array):
+    """ sha256 hex digest of the shape, dtype and contents of an array """
+    array = np.ascontiguousarray(array)
+    return hashlib.sha256(str((array.shape, array.dtype)).encode() + array.tobytes()).hexdigest()
+
+
+class ContentLRU:
+    """
+    Description: Thread-safe LRU map from content keys to values
+
+    Args: number of entries kept: maxsize
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        """ Value stored under key (marked as most recently used), or None """
+        with self.lock:
+            if key not in self.items:
+                return None
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        """ Store value under key, evicting the least recently used entry above maxsize """
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            if len(self.items) > self.maxsize:
+                self.items.popitem(last = False)
+        return value
+
+    def get_or_build(self, key, build):
+        """ Value stored under key, or build() stored under key """
+        value = self.get(key)
+        if value is None:
+            value = self.put(key, build())
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode = 'wb'):
+    """
+    Description: Open a unique temporary file next to path and rename it onto path once the
+    block finishes; the temporary file is removed if the block raises
+
+    Args: destination file: path; file mode: mode = 'wb' ('w')
+
+    Returns: context manager yielding the open temporary file
+    """
+    fd, tmp = tempfile.mkstemp(dir = os.path.dirname(path) or '.', suffix = '.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
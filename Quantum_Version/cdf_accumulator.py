@@ -0,0 +1,103 @@
+""" Streaming CDF estimation from sufficient statistics
+
+The CDF estimate of compute_cdf_from_XY depends on the samples only
+through the per-index sums of (X + iY) and the number of samples, so a
+CDFAccumulator keeps, for every bin, the 2d+1 complex sums and the 2d+1
+counts per Fourier index. Outcome batches (arrays, XYOutcomes or decoded
+hardware results) are folded in as they arrive, accumulators from
+different workers are merged by adding their statistics, and the
+median-of-bins estimate is evaluated on any x grid on demand.
+"""
+import numpy as np
+
+import fourier_filter
+from generate_cdf import index_sums, QCELS_fourier_coeffs
+from xy_outcomes import XYOutcomes
+
+
+class CDFAccumulator:
+    """
+    Description: Per-bin sufficient statistics of the Fourier CDF estimator
+
+    Args: filter coefficients the indices were drawn from: F_coeffs;
+    number of bins of the median estimate: Nbin;
+    samples were drawn with sample_XY_QCELS (complementary filter): QCELS
+    """
+
+    def __init__(self, F_coeffs, Nbin = 1, QCELS = False):
+        self.F_coeffs = np.asarray(F_coeffs)
+        self.QCELS = QCELS
+        n = self.F_coeffs.shape[0]
+        self.sums = np.zeros((Nbin, n), dtype=np.complex128)
+        self.counts = np.zeros((Nbin, n), dtype=np.int64)
+
+    @property
+    def Nbin(self):
+        return self.sums.shape[0]
+
+    def samples(self):
+        """ Number of samples ingested per bin """
+        return self.counts.sum(axis = 1)
+
+    def add(self, outcome_X, outcome_Y = None, J = None, bin = 0, chunk_size = 2**22):
+        """
+        Description: Fold a batch of outcomes into one bin
+
+        Args: +-1 outcomes of any shape, or an XYOutcomes container: outcome_X;
+        +-1 outcomes and Fourier indices of the same shape: outcome_Y, J;
+        bin index: bin; samples per block: chunk_size
+        """
+        n = self.F_coeffs.shape[0]
+        if isinstance(outcome_X, XYOutcomes):
+            blocks = outcome_X.blocks(chunk_size)
+        else:
+            blocks = [(np.ravel(J), outcome_X, outcome_Y)]
+        for J_block, X_block, Y_block in blocks:
+            index_sums(J_block, X_block, Y_block, n, chunk_size, out = self.sums[bin])
+            self.counts[bin] += np.bincount(J_block, minlength = n)
+        return self
+
+    def merge(self, other):
+        """ Add the statistics of another accumulator with the same filter and bins """
+        assert self.sums.shape == other.sums.shape and self.QCELS == other.QCELS
+        assert np.array_equal(self.F_coeffs, other.F_coeffs)
+        self.sums += other.sums
+        self.counts += other.counts
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def coeffs(self, bin):
+        """ Fourier coefficients of the CDF estimate of one bin """
+        F_coeffs = QCELS_fourier_coeffs(self.F_coeffs) if self.QCELS else self.F_coeffs
+        phase_fac = np.exp(1.0j*np.angle(F_coeffs))
+        F_normal_fac = np.sum(np.abs(F_coeffs))
+        return self.sums[bin]*phase_fac*F_normal_fac/self.counts[bin].sum()
+
+    def cdf(self, x, bin = None, chunk_size = 2**22):
+        """
+        Description: CDF estimate on x, the median over all bins with samples (or of one bin)
+
+        Args: evaluation points: x; single bin to evaluate: bin; exp entries per block: chunk_size
+
+        Returns: complex array like compute_cdf_from_XY(_median)
+        """
+        if bin is not None:
+            return fourier_filter.reconstruct_from_fourier(x, self.coeffs(bin), chunk_size)
+        filled = np.flatnonzero(self.samples())
+        y_arr = np.zeros((filled.shape[0], np.size(x)), dtype=np.complex128)
+        for i in range(filled.shape[0]):
+            y_arr[i] = fourier_filter.reconstruct_from_fourier(x, self.coeffs(filled[i]), chunk_size)
+        return np.median(y_arr, 0)
+
+    def save(self, path):
+        np.savez(path, sums = self.sums, counts = self.counts, F_coeffs = self.F_coeffs, QCELS = self.QCELS)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            accumulator = cls(data['F_coeffs'], data['sums'].shape[0], bool(data['QCELS']))
+            accumulator.sums[:] = data['sums']
+            accumulator.counts[:] = data['counts']
+        return accumulator
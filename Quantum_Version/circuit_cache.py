@@ -0,0 +1,139 @@
+""" Content-addressed cache for transpiled Hadamard test circuits
+
+Circuits are keyed by a hash of everything that changes the transpiled
+result (the controlled unitary or its evolution time, the initial state,
+the real/imaginary test, the backend target and the optimization level),
+appended to a single qpy archive and located through a json index. Entries
+are read lazily and the least recently used ones are evicted once the
+archive holds more than max_bytes of live circuits.
+"""
+import hashlib
+import io
+import json
+import os
+
+import numpy as np
+import qiskit
+from qiskit.quantum_info import Operator
+
+from cache_utils import atomic_write
+
+
+def _array_digest(h, A, decimals = 12):
+    # round so that float noise from expm/eigh does not change the key
+    A = np.round(np.asarray(A, dtype=complex), decimals) + 0.0
+    h.update(str(A.shape).encode())
+    h.update(A.tobytes())
+
+
+def circuit_key(unitary, W, init_state, backend, optimization_level = 3, time = None):
+    """
+    Description: Hash the inputs of create_HT_circuit that determine the transpiled circuit
+
+    Args: controlled unitary as a gate or matrix (or any hashable label when time is given): unitary;
+    specifies real (imaginary) HT: W;
+    eigenstate initialization: init_state;
+    transpilation target: backend;
+    transpiler optimization level: optimization_level;
+    evolution time for parameterized unitaries: time
+
+    Returns: hex digest used as the cache key
+    """
+    h = hashlib.sha256()
+    if time is not None:
+        h.update(('time=' + repr(float(time)) + ';' + str(unitary)).encode())
+    elif isinstance(unitary, np.ndarray):
+        _array_digest(h, unitary)
+    else:
+        _array_digest(h, Operator(unitary).data)
+    _array_digest(h, init_state)
+    h.update(('W=' + W[0].upper()).encode())
+    coupling_map = getattr(backend, 'coupling_map', None)
+    target = (backend.name, backend.num_qubits, sorted(backend.operation_names),
+              sorted(coupling_map.get_edges()) if coupling_map is not None else None,
+              getattr(backend.target, 'dt', None), optimization_level)
+    h.update(repr(target).encode())
+    return h.hexdigest()
+
+
+class CircuitCache:
+    """
+    Description: Single-archive LRU cache of transpiled circuits. The archive at path
+    holds concatenated qpy payloads and path + '.json' maps each key to its offset,
+    size and last use.
+
+    Args: archive file: path; limit on the live payload size in bytes: max_bytes
+    """
+
+    def __init__(self, path, max_bytes = 2**30):
+        self.path = path
+        self.index_path = path + '.json'
+        self.max_bytes = max_bytes
+        self.index = {}
+        self.clock = 0
+        if os.path.exists(self.index_path) and os.path.exists(self.path):
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)
+            self.clock = max([entry['used'] for entry in self.index.values()], default = 0)
+        elif os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def live_bytes(self):
+        return sum(entry['size'] for entry in self.index.values())
+
+    def get(self, key):
+        """Load the circuit stored under key, or None on a miss. The last use is only
+        written to disk by the next flush()."""
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        with open(self.path, 'rb') as f:
+            f.seek(entry['offset'])
+            payload = f.read(entry['size'])
+        self.clock += 1
+        entry['used'] = self.clock
+        return qiskit.qpy.load(io.BytesIO(payload))[0]
+
+    def put(self, key, circuit):
+        """Append a circuit to the archive, evicting old entries above max_bytes."""
+        buffer = io.BytesIO()
+        qiskit.qpy.dump(circuit, buffer)
+        payload = buffer.getvalue()
+        with open(self.path, 'ab') as f:
+            offset = f.seek(0, io.SEEK_END)
+            f.write(payload)
+        self.clock += 1
+        self.index[key] = {'offset': offset, 'size': len(payload), 'used': self.clock}
+        self._evict()
+        self.flush()
+
+    def flush(self):
+        """Write the index (including last-use times) to disk."""
+        with atomic_write(self.index_path, 'w') as f:
+            json.dump(self.index, f)
+
+    def _evict(self):
+        live = self.live_bytes()
+        if live <= self.max_bytes:
+            return
+        for key in sorted(self.index, key = lambda k: self.index[k]['used']):
+            if live <= self.max_bytes:
+                break
+            live -= self.index.pop(key)['size']
+        # drop the space of evicted payloads once it dominates the archive
+        if os.path.getsize(self.path) > 2*live:
+            self._compact()
+
+    def _compact(self):
+        with open(self.path, 'rb') as src, atomic_write(self.path) as dst:
+            for entry in sorted(self.index.values(), key = lambda e: e['offset']):
+                src.seek(entry['offset'])
+                payload = src.read(entry['size'])
+                entry['offset'] = dst.tell()
+                dst.write(payload)
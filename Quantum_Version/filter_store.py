@@ -0,0 +1,83 @@
+""" Persistent store of Fourier filter coefficients
+
+H_fourier_coeffs(d), M_fourier_coeffs_normalized(d, delta) and
+F_fourier_coeffs(d, delta) only depend on their parameters. They are
+computed once, saved as .npy files named by the parameters, and loaded
+back with np.load(mmap_mode='r'): parallel workers then share one
+read-only page-cache copy instead of rebuilding their own arrays. An
+in-process LRU keeps the mapped arrays of recent parameters. The alias
+table used to sample |F_fourier_coeffs| is stored the same way.
+
+The returned arrays are read-only; copy them before modifying in place.
+"""
+import functools
+import os
+
+import numpy as np
+
+import alias_sampler
+import fourier_filter
+from cache_utils import atomic_write
+
+store_dir = 'Filter_Coefficients'
+
+
+def _path(name, *params):
+    return os.path.join(store_dir, name + '_' + '_'.join(repr(p) for p in params) + '.npy')
+
+
+def load_or_build(name, build, *params):
+    """
+    Description: Memory-map the stored coefficients, or build and store them first
+
+    Args: file name prefix: name; function computing the coefficients: build;
+    its parameters (part of the file name): params
+
+    Returns: read-only memory-mapped array
+    """
+    path = _path(name, *params)
+    if not os.path.exists(path):
+        os.makedirs(store_dir, exist_ok = True)
+        coeffs = build(*params)
+        # concurrent builders never see partial files
+        with atomic_write(path) as f:
+            np.save(f, coeffs)
+    return np.load(path, mmap_mode = 'r')
+
+
+@functools.lru_cache(maxsize = 16)
+def H_fourier_coeffs(d):
+    return load_or_build('H', fourier_filter.H_fourier_coeffs, int(d))
+
+
+@functools.lru_cache(maxsize = 16)
+def M_fourier_coeffs_normalized(d, delta):
+    return load_or_build('M', fourier_filter.M_fourier_coeffs_normalized, int(d), float(delta))
+
+
+@functools.lru_cache(maxsize = 16)
+def F_fourier_coeffs(d, delta):
+    return load_or_build('F', fourier_filter.F_fourier_coeffs, int(d), float(delta))
+
+
+def _F_alias_table(d, delta):
+    prob, alias = alias_sampler.vose_table(np.abs(F_fourier_coeffs(d, delta)))
+    table = np.zeros(prob.shape[0], dtype=[('prob', np.float64), ('alias', np.int64)])
+    table['prob'] = prob
+    table['alias'] = alias
+    return table
+
+
+@functools.lru_cache(maxsize = 16)
+def F_alias_sampler(d, delta):
+    """ AliasSampler of |F_fourier_coeffs(d, delta)|, stored with the filter and registered
+    with alias_sampler so that draw_with_prob reuses it """
+    table = load_or_build('F_alias', _F_alias_table, int(d), float(delta))
+    sampler = alias_sampler.AliasSampler(prob = table['prob'], alias = table['alias'])
+    return alias_sampler.register(np.abs(F_fourier_coeffs(d, delta)), sampler)
+
+
+def clear_cache():
+    """ Drop the in-process LRU (e.g. after changing store_dir) """
+    for function in (H_fourier_coeffs, M_fourier_coeffs_normalized, F_fourier_coeffs, F_alias_sampler):
+        function.cache_clear()
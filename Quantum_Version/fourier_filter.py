@@ -1,15 +1,19 @@
 import numpy as np
-from numpy.polynomial.chebyshev import chebval
 from matplotlib import pyplot as plt
 
 
 def M_unnormalized(x,d,delta):
-    inside = 1.0 + 2.0 * ((np.cos(x)-np.cos(delta))/(1+np.cos(delta)))
-#     print(inside)
-    c = np.zeros(d+1)
-    c[-1] = 1.0
-#    return chebval(inside,c) + 1.0
-    return chebval(inside,c)
+    # T_d(inside) with inside = 1.0 + 2.0*((cos(x)-cos(delta))/(1+cos(delta))) = 1 - 2s and
+    # s = (sin^2(x/2)-sin^2(delta/2))/cos^2(delta/2) <= 1, evaluated in closed form:
+    # T_d(1-2s) = cos(2d*arcsin(sqrt(s))) for s >= 0 and cosh(2d*arcsinh(sqrt(-s))) for s < 0.
+    # The half-angle form avoids the cancellation in cos(x)-cos(delta) and the O(d)
+    # Clenshaw sum of a Chebyshev series per point.
+    # s is at most 1 (at x = +-pi) but can round above it, where arcsin(sqrt(s)) is NaN
+    s = np.minimum((np.sin(x/2)**2 - np.sin(delta/2)**2)/np.cos(delta/2)**2, 1)
+    inside_interval = s >= 0
+    return np.where(inside_interval,
+                    np.cos(2*d*np.arcsin(np.sqrt(np.where(inside_interval,s,0)))),
+                    np.cosh(2*d*np.arcsinh(np.sqrt(np.where(inside_interval,0,-s)))))
     
     
 def M_fourier_coeffs(d,delta):
@@ -21,16 +25,49 @@ def M_fourier_coeffs(d,delta):
     return (1.0/M)*coeffs_raw
 
 
-def reconstruct_from_fourier(x,fourier_coeffs):
-    d = (fourier_coeffs.shape[0]-1)//2
-    y = np.zeros(fourier_coeffs.shape)
-    k = np.zeros(fourier_coeffs.shape)
+def fourier_indices(n):
+    d = (n-1)//2
+    k = np.zeros(n)
     k[:d+1] = np.arange(d+1)
     k[d+1:] = np.arange(-d,0) # k = 0,1,...,d,-d,-d+1,...,-1
-    exp_array = np.exp(1.0j*np.tensordot(k,x,axes=0))
-    return np.matmul(fourier_coeffs,exp_array)
-#     for k in range(d+1):
-#         exp_array = np.exp(1.0j*k*x)
+    return k
+
+
+def uniform_grid_period(x, max_period):
+    # N such that x is a uniform grid with spacing 2*pi/N for an integer N <= max_period, else None
+    if x.shape[0] < 2:
+        return None
+    h = (x[-1]-x[0])/(x.shape[0]-1)
+    if h <= 0 or np.max(np.abs(np.diff(x)-h)) > 1e-10*max(1.0,np.max(np.abs(x))):
+        return None
+    N = 2*np.pi/h
+    if N > max_period or abs(N-np.round(N)) > 1e-8*N:
+        return None
+    return int(np.round(N))
+
+
+def reconstruct_from_fourier(x,fourier_coeffs,chunk_size=2**22):
+    # sum_k c_k exp(1j*k*x); uniform grids x0 + 2*pi*n/N use one FFT of length N, any other
+    # x is evaluated in blocks of at most chunk_size exp entries
+    x = np.asarray(x,dtype=float)
+    shape = x.shape
+    x = x.ravel()
+    k = fourier_indices(fourier_coeffs.shape[0])
+    N = uniform_grid_period(x, 8*(fourier_coeffs.shape[0]+x.shape[0]))
+    if N is not None:
+        # fold the coefficients modulo N, then y_n = N*ifft(b)[n]
+        shifted = fourier_coeffs*np.exp(1.0j*k*x[0])
+        m = k.astype(np.int64) % N
+        b = np.bincount(m,weights=shifted.real,minlength=N) + 1.0j*np.bincount(m,weights=shifted.imag,minlength=N)
+        y = N*np.fft.ifft(b)
+        y = y[np.arange(x.shape[0]) % N]
+    else:
+        y = np.zeros(x.shape[0],dtype=np.complex128)
+        block = max(1,chunk_size//fourier_coeffs.shape[0])
+        for start in range(0,x.shape[0],block):
+            exp_array = np.exp(1.0j*np.tensordot(k,x[start:start+block],axes=0))
+            y[start:start+block] = np.matmul(fourier_coeffs,exp_array)
+    return y.reshape(shape)
         
     
 def M_fourier_coeffs_normalized(d,delta):
@@ -1,8 +1,12 @@
+import functools
 import numpy as np
 #from numpy.polynomial.chebyshev import chebval
 from matplotlib import pyplot as plt
 
 import fourier_filter
+import filter_store
+import alias_sampler
+from xy_outcomes import XYOutcomes
 
 
 #def compute_prob_X_(T,epsilon_list,popu_list):
@@ -28,20 +32,119 @@ def compute_prob_Y_(T,epsilon_list,popu_list,decay_rate=0.0):
     sin_array = np.sin(-np.tensordot(epsilon_list,T,axes=0))
     p = np.exp(-decay_rate*np.abs(T))
     return p*0.5*np.matmul(popu_list,sin_array) + 0.5
+
+
+class SignalTable:
+    # compute_prob_X_/compute_prob_Y_ tabulated once for the integer times -d,...,d (shifted by t,
+    # as in sample_XY_QCELS); probabilities are then served by fancy-indexing instead of a
+    # K x Nsample trig evaluation per batch. Times off the table fall back to direct evaluation.
+
+    def __init__(self,epsilon_list,popu_list,d,t=0.0,decay_rate=0.0,chunk_size=2**22):
+        self.epsilon_list = np.asarray(epsilon_list)
+        self.popu_list = np.asarray(popu_list)
+        self.d = d
+        self.t = t
+        self.decay_rate = decay_rate
+        T = np.arange(-d,d+1) + t
+        # sum_k popu_k exp(-i eps_k T), a block of eigenvalues at a time
+        self.signal = np.zeros(2*d+1,dtype=np.complex128)
+        block = max(1,chunk_size//(2*d+1))
+        for start in range(0,self.epsilon_list.shape[0],block):
+            exp_array = np.exp(-1.0j*np.tensordot(self.epsilon_list[start:start+block],T,axes=0))
+            self.signal += np.matmul(self.popu_list[start:start+block],exp_array)
+        self.signal *= np.exp(-decay_rate*np.abs(T))
+
+    def _index(self,T):
+        n = np.rint(np.asarray(T) - self.t)
+        if np.all(np.abs(np.asarray(T) - self.t - n) < 1e-9) and np.all(np.abs(n) <= self.d):
+            return n.astype(np.int64) + self.d
+        return None
+
+    def prob_X(self,T):
+        index = self._index(T)
+        if index is None:
+            return compute_prob_X_(T,self.epsilon_list,self.popu_list,self.decay_rate)
+        return 0.5*self.signal.real[index] + 0.5
+
+    def prob_Y(self,T):
+        index = self._index(T)
+        if index is None:
+            return compute_prob_Y_(T,self.epsilon_list,self.popu_list,self.decay_rate)
+        return 0.5*self.signal.imag[index] + 0.5
 # -------------------------------------------------------
 
 
-def draw_with_prob(measure,Nsample):
-    L = measure.shape[0]
-    cdf_measure = np.cumsum(measure)
-    normal_fac = cdf_measure[-1]
-    U = np.random.rand(Nsample) * normal_fac
-    j = np.searchsorted(cdf_measure,U)
-    return j
-    
-    
-def generate_cdf(x, compute_prob_X, compute_prob_Y, F_coeffs, Nsample, Nbatch):
+def as_generator(rng):
+    # None keeps the global np.random stream (legacy behaviour); seeds become Generators
+    if rng is None or isinstance(rng, np.random.Generator):
+        return rng
+    return np.random.default_rng(rng)
+
 
+def uniform(rng,Nsample):
+    if rng is None:
+        return np.random.rand(Nsample)
+    return rng.random(Nsample)
+
+
+def spawn_generators(rng,Nbin):
+    # independent streams for every bin; they only depend on the seed, not on the workers
+    if isinstance(rng, np.random.Generator):
+        seeds = rng.bit_generator.seed_seq.spawn(Nbin)
+    else:
+        seeds = np.random.SeedSequence(rng).spawn(Nbin)
+    return [np.random.default_rng(seed) for seed in seeds]
+
+
+def map_bins(function,rng,Nbin,executor=None):
+    # function(rng) for every bin; serial on the global stream when neither rng nor executor is given
+    if rng is None and executor is None:
+        return [function(None) for ixbin in range(Nbin)]
+    generators = spawn_generators(rng,Nbin)
+    if executor is None:
+        return [function(generator) for generator in generators]
+    return list(executor.map(function,generators))
+
+
+def draw_with_prob(measure,Nsample,rng=None,out=None):
+    # measure: weights, or a prebuilt AliasSampler (e.g. filter_store.F_alias_sampler(d, delta)).
+    # Weights are looked up in the alias_sampler cache by hash on every call; callers drawing
+    # repeatedly from the same measure should pass the sampler to skip the lookup.
+    if not isinstance(measure, alias_sampler.AliasSampler):
+        measure = alias_sampler.cached(measure)
+    return measure.sample(Nsample,rng,out)
+    
+    
+def index_sums(J_arr, outcome_X_arr, outcome_Y_arr, n, chunk_size=2**22, out=None):
+    # per-index sums of (outcome_X + i*outcome_Y); J takes only n = 2d+1 values.
+    # Samples are read in blocks of chunk_size and accumulated into out in place.
+    if out is None:
+        out = np.zeros(n,dtype=np.complex128)
+    J_arr = np.ravel(J_arr)
+    outcome_X_arr = np.ravel(outcome_X_arr)
+    outcome_Y_arr = np.ravel(outcome_Y_arr)
+    for start in range(0,J_arr.shape[0],chunk_size):
+        J_block = J_arr[start:start+chunk_size]
+        out.real += np.bincount(J_block, weights=np.real(outcome_X_arr[start:start+chunk_size]), minlength=n)
+        out.imag += np.bincount(J_block, weights=np.real(outcome_Y_arr[start:start+chunk_size]), minlength=n)
+    return out
+
+
+def QCELS_fourier_coeffs(F_coeffs):
+    # coefficients of 1 - F(-x), sampled by sample_XY_QCELS
+    d = (F_coeffs.shape[0]-1)//2
+    F_coeffs_new=np.zeros(len(F_coeffs),dtype=np.complex128)
+    a=-F_coeffs[d+1:]
+    F_coeffs_new[1:d+1]=a[::-1]
+    a=-F_coeffs[1:d+1]
+    F_coeffs_new[d+1:]=a[::-1]
+    F_coeffs_new[0]=1-F_coeffs[0]
+    return F_coeffs_new
+
+
+def generate_cdf(x, compute_prob_X, compute_prob_Y, F_coeffs, Nsample, Nbatch, rng=None):
+
+    rng = as_generator(rng)
     d = (F_coeffs.shape[0]-1)//2
     T_list = np.zeros(2*d + 1)
     T_list[:d+1] = np.arange(d+1)
@@ -50,43 +153,45 @@ def generate_cdf(x, compute_prob_X, compute_prob_Y, F_coeffs, Nsample, Nbatch):
     phase_fac = np.exp(1.0j*angles)
     F_normal_fac = np.sum(np.abs(F_coeffs))
     
-    Nx = x.shape[0]
-    y_sum = np.zeros(Nx,dtype=np.complex128)
+    # the estimator only depends on the outcomes through their per-index sums, so all
+    # batches are aggregated into 2d+1 coefficients and evaluated on x once
+    coeffs = np.zeros(2*d + 1,dtype=np.complex128)
+    sampler = alias_sampler.cached(np.abs(F_coeffs))
+    J_list = np.empty(Nsample,dtype=np.int64)
     for nbatch in range(Nbatch):
 
-        J_list = draw_with_prob(np.abs(F_coeffs),Nsample)
+        sampler.sample(Nsample,rng,out=J_list)
         p_X = compute_prob_X(T_list[J_list])
         p_Y = compute_prob_Y(T_list[J_list])
-        # print(outcome)
-        # print(np.imag(F_coeffs))
-        # reconstructed_signal = 
-        U = np.random.rand(Nsample)
+        U = uniform(rng,Nsample)
         outcome_X = 2*(U<p_X)-1
-        U = np.random.rand(Nsample)
+        U = uniform(rng,Nsample)
         outcome_Y = 2*(U<p_Y)-1
 
+        coeffs += index_sums(J_list, outcome_X, outcome_Y, 2*d + 1)
     
-        exp_array = np.exp(1.0j*np.tensordot(T_list[J_list],x,axes=0))
-        y = np.matmul((outcome_X + 1.0j*outcome_Y)*phase_fac[J_list],exp_array)/Nsample*F_normal_fac
-
-        y_sum += y
-    
-    y_avg = y_sum/Nbatch
+    coeffs *= phase_fac*F_normal_fac/(Nsample*Nbatch)
+    y_avg = fourier_filter.reconstruct_from_fourier(x,coeffs)
     return y_avg
     
     
-def generate_cdf_median(x, compute_prob_X, compute_prob_Y, F_coeffs, Nsample, Nbatch, Nbin):
+def generate_cdf_median(x, compute_prob_X, compute_prob_Y, F_coeffs, Nsample, Nbatch, Nbin, rng=None, executor=None):
+    # every bin draws from its own SeedSequence child of rng, so the result for a given seed
+    # does not depend on the executor (which needs picklable compute_prob_X/Y, e.g. functools.partial)
 
     Nx = x.shape[0]
     y_arr = np.zeros([Nbin,Nx],dtype=np.complex128)
+    bins = map_bins(functools.partial(generate_cdf, x, compute_prob_X, compute_prob_Y, F_coeffs, Nsample, Nbatch), rng, Nbin, executor)
     for ixbin in range(Nbin):
-        y_arr[ixbin,:] = generate_cdf(x, compute_prob_X, compute_prob_Y, F_coeffs, Nsample, Nbatch)
+        y_arr[ixbin,:] = bins[ixbin]
     y_median = np.median(y_arr,0)
     return y_median
     
     
-def sample_XY(compute_prob_X, compute_prob_Y, F_coeffs, Nsample, Nbatch):
+def sample_XY(compute_prob_X, compute_prob_Y, F_coeffs, Nsample, Nbatch, rng=None, compact=False):
+    # compact=True returns an XYOutcomes container instead of (outcome_X_arr, outcome_Y_arr, J_arr)
     
+    rng = as_generator(rng)
     d = (F_coeffs.shape[0]-1)//2
     T_list = np.zeros(2*d + 1)
     T_list[:d+1] = np.arange(d+1)
@@ -95,85 +200,100 @@ def sample_XY(compute_prob_X, compute_prob_Y, F_coeffs, Nsample, Nbatch):
     phase_fac = np.exp(1.0j*angles)
     F_normal_fac = np.sum(np.abs(F_coeffs))
     
-    outcome_X_arr = np.zeros([Nbatch,Nsample],dtype=np.complex128)
-    outcome_Y_arr = np.zeros([Nbatch,Nsample],dtype=np.complex128)
-    J_arr = np.zeros([Nbatch,Nsample],dtype=np.int)
+    outcomes = XYOutcomes.empty((Nbatch,Nsample), 2*d + 1)
+    sampler = alias_sampler.cached(np.abs(F_coeffs))
+    J_list = np.empty(Nsample,dtype=np.int64)
     for nbatch in range(Nbatch):
-        J_list = draw_with_prob(np.abs(F_coeffs),Nsample)
-        J_arr[nbatch,:] = J_list
+        sampler.sample(Nsample,rng,out=J_list)
         p_X = compute_prob_X(T_list[J_list])
         p_Y = compute_prob_Y(T_list[J_list])
-        U = np.random.rand(Nsample)
-        outcome_X_arr[nbatch,:] = 2*(U<p_X)-1
-        U = np.random.rand(Nsample)
-        outcome_Y_arr[nbatch,:] = 2*(U<p_Y)-1
+        U = uniform(rng,Nsample)
+        outcome_X = 2*(U<p_X)-1
+        U = uniform(rng,Nsample)
+        outcome_Y = 2*(U<p_Y)-1
+        outcomes[nbatch] = (outcome_X, outcome_Y, J_list)
     
-    return outcome_X_arr, outcome_Y_arr, J_arr
+    if compact:
+        return outcomes
+    return outcomes.as_arrays()
     
     
-def sample_XY_median(compute_prob_X, compute_prob_Y, F_coeffs, Nsample, Nbatch, Nbin):
+def sample_XY_median(compute_prob_X, compute_prob_Y, F_coeffs, Nsample, Nbatch, Nbin, rng=None, executor=None, compact=False):
 
-    outcome_X_arr_cube = np.zeros([Nbin,Nbatch,Nsample],dtype=np.complex128)
-    outcome_Y_arr_cube = np.zeros([Nbin,Nbatch,Nsample],dtype=np.complex128)
-    J_arr_cube = np.zeros([Nbin,Nbatch,Nsample],dtype=np.int)
+    cube = XYOutcomes.empty((Nbin,Nbatch,Nsample), F_coeffs.shape[0])
     
+    bins = map_bins(functools.partial(sample_XY, compute_prob_X, compute_prob_Y, F_coeffs, Nsample, Nbatch, compact=True), rng, Nbin, executor)
     for ixbin in range(Nbin):
-        outcome_X_arr, outcome_Y_arr, J_arr = sample_XY(compute_prob_X, 
-                        compute_prob_Y, F_coeffs, Nsample, Nbatch)
-        outcome_X_arr_cube[ixbin,:,:] = outcome_X_arr
-        outcome_Y_arr_cube[ixbin,:,:] = outcome_Y_arr
-        J_arr_cube[ixbin,:,:] = J_arr
+        cube[ixbin] = bins[ixbin]
     
-    return outcome_X_arr_cube, outcome_Y_arr_cube, J_arr_cube
+    if compact:
+        return cube
+    return cube.as_arrays()
     
     
-def compute_cdf_from_XY(x, outcome_X_arr, outcome_Y_arr, J_arr, F_coeffs):
-
-    d = (F_coeffs.shape[0]-1)//2
-    T_list = np.zeros(2*d + 1)
-    T_list[:d+1] = np.arange(d+1)
-    T_list[d+1:] = np.arange(-d,0)
-    angles = np.angle(F_coeffs)
-    phase_fac = np.exp(1.0j*angles)
+def cdf_coeffs_from_XY(outcome_X_arr, outcome_Y_arr, J_arr, F_coeffs, chunk_size=2**22):
+    # Fourier coefficients of the CDF estimate; O(d) memory for any number of samples.
+    # outcome_X_arr may be an XYOutcomes container (then outcome_Y_arr and J_arr are unused).
+    phase_fac = np.exp(1.0j*np.angle(F_coeffs))
     F_normal_fac = np.sum(np.abs(F_coeffs))
-    
-    Nbatch, Nsample = J_arr.shape
-    Nx = x.shape[0]
-    y_sum = np.zeros(Nx,dtype=np.complex128)
-    for nbatch in range(Nbatch):
-        J_list = J_arr[nbatch,:]
-        exp_array = np.exp(1.0j*np.tensordot(T_list[J_list],x,axes=0))
-        y = np.matmul((outcome_X_arr[nbatch,:] + 1.0j*outcome_Y_arr[nbatch,:])*phase_fac[J_list],exp_array)/Nsample*F_normal_fac
+    if isinstance(outcome_X_arr, XYOutcomes):
+        Nbatch, Nsample = outcome_X_arr.shape
+        coeffs = np.zeros(F_coeffs.shape[0],dtype=np.complex128)
+        for J_block, X_block, Y_block in outcome_X_arr.blocks(chunk_size):
+            index_sums(J_block, X_block, Y_block, F_coeffs.shape[0], chunk_size, out=coeffs)
+    else:
+        Nbatch, Nsample = J_arr.shape
+        coeffs = index_sums(J_arr, outcome_X_arr, outcome_Y_arr, F_coeffs.shape[0], chunk_size)
+    coeffs *= phase_fac
+    coeffs *= F_normal_fac/(Nsample*Nbatch)
+    return coeffs
 
-        y_sum += y
-    
-    y_avg = y_sum/Nbatch
+
+def iter_cdf_from_XY(x, outcome_X_arr, outcome_Y_arr=None, J_arr=None, F_coeffs=None, chunk_size=2**22, QCELS=False):
+    # yields (slice of x, CDF estimate on it) block by block, so that the peak memory is
+    # fixed by chunk_size and not by the number of samples or grid points
+    if QCELS:
+        F_coeffs = QCELS_fourier_coeffs(F_coeffs)
+    coeffs = cdf_coeffs_from_XY(outcome_X_arr, outcome_Y_arr, J_arr, F_coeffs, chunk_size)
+    block = max(1,chunk_size//coeffs.shape[0])
+    for start in range(0,x.shape[0],block):
+        grid_block = slice(start,min(start+block,x.shape[0]))
+        yield grid_block, fourier_filter.reconstruct_from_fourier(x[grid_block],coeffs,chunk_size)
+
+
+def compute_cdf_from_XY(x, outcome_X_arr, outcome_Y_arr=None, J_arr=None, F_coeffs=None, chunk_size=2**22):
+    # accepts the three arrays of sample_XY, or an XYOutcomes container with F_coeffs by keyword
+
+    coeffs = cdf_coeffs_from_XY(outcome_X_arr, outcome_Y_arr, J_arr, F_coeffs, chunk_size)
+    y_avg = fourier_filter.reconstruct_from_fourier(x,coeffs,chunk_size)
     return y_avg
 
 
     
-def compute_cdf_from_XY_median(x, outcome_X_arr_cube, outcome_Y_arr_cube, J_arr_cube, F_coeffs):
+def compute_cdf_from_XY_median(x, outcome_X_arr_cube, outcome_Y_arr_cube=None, J_arr_cube=None, F_coeffs=None, chunk_size=2**22):
 
-    Nbin, Nbatch, Nsample = J_arr_cube.shape
+    if isinstance(outcome_X_arr_cube, XYOutcomes):
+        Nbin, Nbatch, Nsample = outcome_X_arr_cube.shape
+    else:
+        Nbin, Nbatch, Nsample = J_arr_cube.shape
     
     Nx = x.shape[0]
     y_arr = np.zeros([Nbin,Nx],dtype=np.complex128)
     for ixbin in range(Nbin):
-        y_arr[ixbin,:] = compute_cdf_from_XY(x, 
-            outcome_X_arr_cube[ixbin,:,:], outcome_Y_arr_cube[ixbin,:,:], 
-            J_arr_cube[ixbin,:,:], F_coeffs)
+        if isinstance(outcome_X_arr_cube, XYOutcomes):
+            y_arr[ixbin,:] = compute_cdf_from_XY(x, outcome_X_arr_cube[ixbin], F_coeffs=F_coeffs, chunk_size=chunk_size)
+        else:
+            y_arr[ixbin,:] = compute_cdf_from_XY(x, 
+                outcome_X_arr_cube[ixbin,:,:], outcome_Y_arr_cube[ixbin,:,:], 
+                J_arr_cube[ixbin,:,:], F_coeffs, chunk_size)
     y_median = np.median(y_arr,0)
     return y_median
 
-def sample_XY_QCELS(compute_prob_X, compute_prob_Y, F_coeffs, Nsample, Nbatch,t):
+def sample_XY_QCELS(compute_prob_X, compute_prob_Y, F_coeffs, Nsample, Nbatch,t, rng=None, compact=False):
     
+    rng = as_generator(rng)
     d = (F_coeffs.shape[0]-1)//2
-    F_coeffs_new=np.zeros(len(F_coeffs),dtype=np.complex128)
-    a=-F_coeffs[d+1:]
-    F_coeffs_new[1:d+1]=a[::-1]
-    a=-F_coeffs[1:d+1]
-    F_coeffs_new[d+1:]=a[::-1]
-    F_coeffs_new[0]=1-F_coeffs[0]
+    F_coeffs_new=QCELS_fourier_coeffs(F_coeffs)
     T_list = np.zeros(2*d + 1)
     T_list[:d+1] = np.arange(d+1)
     T_list[d+1:] = np.arange(-d,0)
@@ -181,46 +301,27 @@ def sample_XY_QCELS(compute_prob_X, compute_prob_Y, F_coeffs, Nsample, Nbatch,t)
     phase_fac_new = np.exp(1.0j*angles_new)
     F_normal_fac_new = np.sum(np.abs(F_coeffs_new))
     
-    outcome_X_arr = np.zeros([Nbatch,Nsample],dtype=np.complex128)
-    outcome_Y_arr = np.zeros([Nbatch,Nsample],dtype=np.complex128)
-    J_arr = np.zeros([Nbatch,Nsample],dtype=np.int)
+    outcomes = XYOutcomes.empty((Nbatch,Nsample), 2*d + 1)
+    sampler = alias_sampler.cached(np.abs(F_coeffs_new))
+    J_list = np.empty(Nsample,dtype=np.int64)
     for nbatch in range(Nbatch):
-        J_list = draw_with_prob(np.abs(F_coeffs_new),Nsample)
-        J_arr[nbatch,:] = J_list
+        sampler.sample(Nsample,rng,out=J_list)
         p_X = compute_prob_X(T_list[J_list]+t)# - to match the - in compute_prob_X 
         p_Y = compute_prob_Y(T_list[J_list]+t)
-        U = np.random.rand(Nsample)
-        outcome_X_arr[nbatch,:] = 2*(U<p_X)-1
-        U = np.random.rand(Nsample)
-        outcome_Y_arr[nbatch,:] = 2*(U<p_Y)-1
+        U = uniform(rng,Nsample)
+        outcome_X = 2*(U<p_X)-1
+        U = uniform(rng,Nsample)
+        outcome_Y = 2*(U<p_Y)-1
+        outcomes[nbatch] = (outcome_X, outcome_Y, J_list)
     
-    return outcome_X_arr, outcome_Y_arr, J_arr
+    if compact:
+        return outcomes
+    return outcomes.as_arrays()
 
-def compute_cdf_from_XY_QCELS(x, outcome_X_arr, outcome_Y_arr, J_arr, F_coeffs):
+def compute_cdf_from_XY_QCELS(x, outcome_X_arr, outcome_Y_arr=None, J_arr=None, F_coeffs=None, chunk_size=2**22):
 #data generator
-    d = (F_coeffs.shape[0]-1)//2
-    F_coeffs_new=np.zeros(len(F_coeffs),dtype=np.complex128)
-    a=np.zeros(d,dtype=np.complex128)
-    a=-F_coeffs[d+1:]
-    F_coeffs_new[1:d+1]=a[::-1]
-    a=-F_coeffs[1:d+1]
-    F_coeffs_new[d+1:]=a[::-1]
-    F_coeffs_new[0]=1-F_coeffs[0]
-    T_list = np.zeros(2*d + 1)
-    T_list[:d+1] = np.arange(d+1)
-    T_list[d+1:] = np.arange(-d,0)
-    angles_new = np.angle(F_coeffs_new)
-    phase_fac_new = np.exp(1.0j*angles_new)
-    F_normal_fac_new = np.sum(np.abs(F_coeffs_new))
-    Nbatch, Nsample = J_arr.shape
-    y_sum = 0
-    for nbatch in range(Nbatch):
-        J_list = J_arr[nbatch,:]
-        exp_array = np.exp(1.0j*np.tensordot(T_list[J_list],x,axes=0))
-        y = np.matmul((outcome_X_arr[nbatch,:] + 1.0j*outcome_Y_arr[nbatch,:])*phase_fac_new[J_list],exp_array)/Nsample*F_normal_fac_new
-        y_sum += y
-    
-    y_avg = y_sum/Nbatch
+    coeffs = cdf_coeffs_from_XY(outcome_X_arr, outcome_Y_arr, J_arr, QCELS_fourier_coeffs(F_coeffs), chunk_size)
+    y_avg = fourier_filter.reconstruct_from_fourier(x,coeffs,chunk_size)
     return y_avg
     
     
@@ -229,15 +330,17 @@ if __name__ == "__main__":
     d = 20000
     delta = 0.001
 #    Nsample = 1000
-    F_coeffs = fourier_filter.F_fourier_coeffs(d,delta)
+    F_coeffs = filter_store.F_fourier_coeffs(d,delta)
+    filter_store.F_alias_sampler(d,delta)
 #    x = np.random.randn(Nsample) % np.pi
 #    y = fourier_filter.reconstruct_from_fourier(x,F_coeffs)
 #    plt.scatter(x,np.real(y),s=1)
 
     epsilon_list = np.asarray([-0.2*np.pi,0.1*np.pi,0.15*np.pi])
     popu_list = np.asarray([0.6,0.3,0.1])
-    compute_prob_X = lambda T: compute_prob_X_(T,epsilon_list,popu_list)
-    compute_prob_Y = lambda T: compute_prob_Y_(T,epsilon_list,popu_list)
+    signal_table = SignalTable(epsilon_list,popu_list,d)
+    compute_prob_X = signal_table.prob_X
+    compute_prob_Y = signal_table.prob_Y
     
     Nsample = 400
     Nbatch = 10
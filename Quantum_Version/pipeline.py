@@ -0,0 +1,53 @@
+""" Overlapped transpile / submit / collect pipeline for SamplerV2 runs
+
+The circuits of an experiment are split into chunks. While chunk k is
+submitted, chunk k+1 is already being prepared (transpiled) in a
+background thread, and the results of submitted jobs are collected as
+futures, so the wall time approaches the slowest stage instead of the sum
+of all stages.
+"""
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def run_pipeline(chunks, sampler, shots, prepare = None, max_pending = 2, on_submit = None, on_result = None):
+    """
+    Description: Prepare, submit and collect chunks of circuits with overlapping stages
+
+    Args: list of chunks (circuit lists, or inputs of prepare): chunks;
+    SamplerV2 used for submission: sampler;
+    shots per circuit: shots;
+    callable turning a chunk into a list of circuits, run in a background thread: prepare;
+    maximum number of submitted jobs whose results are not collected yet: max_pending;
+    callable(k, job) invoked right after chunk k is submitted: on_submit;
+    callable(k, result) invoked (in a collector thread) once the result of chunk k arrives: on_result
+
+    Returns: list of PrimitiveResults in chunk order; list of submitted jobs
+    """
+    if prepare is None:
+        prepare = lambda chunk: chunk
+
+    def collect(k, job):
+        result = job.result()
+        if on_result is not None:
+            on_result(k, result)
+        return result
+
+    jobs = []
+    futures = []
+    with ThreadPoolExecutor(max_workers = 1) as prepare_pool, ThreadPoolExecutor(max_workers = max_pending) as collect_pool:
+        next_chunk = prepare_pool.submit(prepare, chunks[0]) if chunks else None
+        for k in range(len(chunks)):
+            circuits = next_chunk.result()
+            if k + 1 < len(chunks):
+                next_chunk = prepare_pool.submit(prepare, chunks[k + 1])
+            pending = [f for f in futures if not f.done()]
+            while len(pending) >= max_pending:
+                wait(pending, return_when = FIRST_COMPLETED)
+                pending = [f for f in pending if not f.done()]
+            job = sampler.run(circuits, shots = shots)
+            jobs.append(job)
+            if on_submit is not None:
+                on_submit(k, job)
+            futures.append(collect_pool.submit(collect, k, job))
+        results = [f.result() for f in futures]
+    return results, jobs
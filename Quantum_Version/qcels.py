@@ -5,23 +5,32 @@ estimate the ground-state energy with reduced circuit depth.
 
 Last revision: 11/22/2022
 """
+import os
 import numpy as np
-from numpy.linalg import eigh
 from scipy.linalg import svd
-from scipy.optimize import minimize
+from scipy.optimize import minimize, OptimizeResult
 from scipy.special import erf
 import fejer_kernel
 import fourier_filter
 import generate_cdf
+import signal_engine
+import circuit_cache
+import spectrum
+import result_manifest
+import run_checkpoint
 
-from qiskit import transpile
+from qiskit.transpiler import generate_preset_pass_manager
 from qiskit_aer import AerSimulator
 from qiskit.circuit import QuantumCircuit, QuantumRegister, ClassicalRegister
 from qiskit_ibm_runtime import SamplerV2 as Sampler
-from qiskit.circuit.library import UnitaryGate, QFT
-from scipy.linalg import expm
+from qiskit.circuit import Parameter
+from qiskit.circuit.library import UnitaryGate, QFT, PauliEvolutionGate
+from qiskit.quantum_info import SparsePauliOp, Operator
+from qiskit.synthesis import LieTrotter, SuzukiTrotter
 
 ham_shift = 3*np.pi/4
+ht_time = Parameter('t') # evolution time of Hadamard test templates
+_pass_managers = {}
 
 def flatten(xss):
     return [x for xs in xss for x in xs]
@@ -45,17 +54,16 @@ def closest_unitary(A):
     U = np.matrix(V.dot(Wh))
     return U
 
-def create_HT_circuit(qubits, unitary, W = 'Re', backend = AerSimulator(), init_state = []):
+def build_HT_circuit(qubits, unitary, W = 'Re', init_state = []):
     """
-    Description: The code to create a Hadamard test circuits for a unitary operator 
+    Description: Build (but do not transpile) a Hadamard test circuit for a controlled unitary
 
     Args: number of qubits to represent the eigenstate: qubits; 
-    time evolution unitary operator: unitary; 
+    controlled time evolution operator: unitary; 
     specifies real (imaginary) HT: W = 'Re'('Im'); 
-    pecifies simulation (hardware) backend: backend = AerSimulator() (ibm_'hardware');
     eigenstate initialization with p0 overlap with ground_state: init_state
 
-    Returns: a transpiled HT circuit: trans_qc
+    Returns: an untranspiled HT circuit: qc
     """
     qr_ancilla = QuantumRegister(1)
     qr_eigenstate = QuantumRegister(qubits)
@@ -70,16 +78,206 @@ def create_HT_circuit(qubits, unitary, W = 'Re', backend = AerSimulator(), init_
     qc.h(qr_ancilla)
     qc.measure(qr_ancilla[0],cr[0])
     #print(qc)
-    trans_qc = transpile(qc, backend, optimization_level=3)
+    return qc
+
+def create_HT_circuit(qubits, unitary, W = 'Re', backend = AerSimulator(), init_state = [], optimization_level = 3, cache = None):
+    """
+    Description: The code to create a Hadamard test circuits for a unitary operator 
+
+    Args: number of qubits to represent the eigenstate: qubits; 
+    time evolution unitary operator: unitary; 
+    specifies real (imaginary) HT: W = 'Re'('Im'); 
+    pecifies simulation (hardware) backend: backend = AerSimulator() (ibm_'hardware');
+    eigenstate initialization with p0 overlap with ground_state: init_state;
+    transpiler optimization level: optimization_level;
+    circuit_cache.CircuitCache to reuse earlier transpilations: cache
+
+    Returns: a transpiled HT circuit: trans_qc
+    """
+    if cache is not None:
+        key = circuit_cache.circuit_key(unitary, W, init_state, backend, optimization_level)
+        trans_qc = cache.get(key)
+        if trans_qc is not None:
+            cache.flush()
+            return trans_qc
+    qc = build_HT_circuit(qubits, unitary, W = W, init_state = init_state)
+    trans_qc = get_pass_manager(backend, optimization_level).run(qc)
+    if cache is not None:
+        cache.put(key, trans_qc)
     return trans_qc
 
+def get_pass_manager(backend, optimization_level = 3):
+    """
+    Description: Preset pass manager for a backend, built once and reused for every transpilation
+
+    Args: simulation (hardware) backend: backend; transpiler optimization level: optimization_level
+
+    Returns: a preset StagedPassManager
+    """
+    key = (id(backend), optimization_level)
+    if key not in _pass_managers:
+        # keep a reference to the backend so that its id is not reused
+        _pass_managers[key] = (backend, generate_preset_pass_manager(optimization_level = optimization_level, backend = backend))
+    return _pass_managers[key][1]
+
+def transpile_HT_circuits(specs, backend = AerSimulator(), optimization_level = 3, num_processes = None, cache = None):
+    """
+    Description: Transpile a whole batch of Hadamard test circuits with one preset pass
+    manager across a process pool. Circuits found in the cache are not transpiled again.
+
+    Args: list of (qubits, unitary, W, init_state) tuples, or already transpiled circuits
+    which are passed through unchanged: specs;
+    simulation (hardware) backend: backend;
+    transpiler optimization level: optimization_level;
+    number of worker processes: num_processes (default: all cores);
+    circuit_cache.CircuitCache to reuse earlier transpilations: cache
+
+    Returns: list of transpiled HT circuits in the order of specs
+    """
+    trans_qcs = [None]*len(specs)
+    keys = [None]*len(specs)
+    pending = []
+    for i, spec in enumerate(specs):
+        if isinstance(spec, QuantumCircuit):
+            trans_qcs[i] = spec
+            continue
+        qubits, unitary, W, init_state = spec
+        if cache is not None:
+            keys[i] = circuit_cache.circuit_key(unitary, W, init_state, backend, optimization_level)
+            trans_qcs[i] = cache.get(keys[i])
+        if trans_qcs[i] is None:
+            pending.append(i)
+    if pending:
+        qcs = [build_HT_circuit(specs[i][0], specs[i][1], W = specs[i][2], init_state = specs[i][3]) for i in pending]
+        if num_processes is None:
+            num_processes = os.cpu_count()
+        results = get_pass_manager(backend, optimization_level).run(qcs, num_processes = num_processes)
+        for i, trans_qc in zip(pending, results):
+            trans_qcs[i] = trans_qc
+            if cache is not None:
+                cache.put(keys[i], trans_qc)
+    if cache is not None:
+        # persist the last-use times of the cache hits once per batch
+        cache.flush()
+    return trans_qcs
+
+def create_HT_template(qubits, hamiltonian, W = 'Re', backend = AerSimulator(), init_state = [], reps = 1, order = 1):
+    """
+    Description: Create a transpiled Hadamard test template for exp(-iHt) with the evolution
+    time left as the Parameter ht_time, so that circuits for different times only need
+    bind_HT_template instead of a new transpilation. The evolution is product formula
+    synthesized with reps steps, i.e. with Trotter angle t/reps.
+
+    Args: number of qubits to represent the eigenstate: qubits; 
+    Hamiltonian as a matrix or SparsePauliOp: hamiltonian; 
+    specifies real (imaginary) HT: W = 'Re'('Im'); 
+    specifies simulation (hardware) backend: backend = AerSimulator() (ibm_'hardware');
+    eigenstate initialization with p0 overlap with ground_state: init_state;
+    number of Trotter steps: reps; 
+    product formula order, 1 (Lie-Trotter) or even (Suzuki-Trotter): order
+
+    Returns: a transpiled HT circuit parameterized by ht_time: template
+    """
+    if not isinstance(hamiltonian, SparsePauliOp):
+        hamiltonian = SparsePauliOp.from_operator(Operator(np.asarray(hamiltonian)))
+    synthesis = LieTrotter(reps = reps) if order == 1 else SuzukiTrotter(order = order, reps = reps)
+    evolution = PauliEvolutionGate(hamiltonian, time = ht_time, synthesis = synthesis)
+    qc = build_HT_circuit(qubits, evolution.control(), W = W, init_state = init_state)
+    template = get_pass_manager(backend, 3).run(qc)
+    return template
+
+def bind_HT_template(template, t):
+    """
+    Description: Bind the evolution time of a template from create_HT_template
+
+    Args: transpiled HT template: template; evolution time: t
+
+    Returns: a transpiled HT circuit for exp(-iHt)
+    """
+    return template.assign_parameters({ht_time: t})
+
 def qcels_opt_fun(x, ts, Z_est):
     NT = ts.shape[0]
     Z_fit=np.zeros(NT,dtype = 'complex') # 'complex_'
     Z_fit=(x[0]+1j*x[1])*np.exp(-1j*x[2]*ts)
     return (np.linalg.norm(Z_fit-Z_est)**2/NT)
 
+def qcels_varpro(ts, Z_est, lambda_min, lambda_max, num_grid = None, newton_steps = 5):
+    """
+    Description: Variable-projection solver for the QCELS fit. For a fixed \lambda the
+    optimal amplitude is r(\lambda) = mean(Z_est*exp(1j*\lambda*ts)), so the objective
+    reduces to mean(|Z_est|^2) - |r(\lambda)|^2. The profiled objective is scanned on a
+    grid over [lambda_min, lambda_max] and the best grid point is refined with analytic
+    Newton steps on |r(\lambda)|^2. Leading axes of ts, Z_est, lambda_min and
+    lambda_max are treated as independent problems and broadcast against each other.
+
+    Args: time points: ts (..., NT);
+    expectation values of time evolution: Z_est (..., NT);
+    search window for \lambda: lambda_min, lambda_max (...);
+    number of grid points: num_grid (default resolves the fit peak ~8 times);
+    number of Newton refinements: newton_steps
+
+    Returns: amplitudes: r (...); energies: lam (...); objective values: fun (...)
+    """
+    ts = np.asarray(ts, dtype=float)
+    Z_est = np.asarray(Z_est, dtype=complex)
+    lambda_min = np.asarray(lambda_min, dtype=float)
+    lambda_max = np.asarray(lambda_max, dtype=float)
+    NT = Z_est.shape[-1]
+    if num_grid is None:
+        # peaks of |r|^2 have width ~2*pi/max(ts); sample each one about 8 times
+        span = np.max((lambda_max - lambda_min)*np.max(np.abs(ts), axis=-1))
+        num_grid = int(min(max(8*span/(2*np.pi), 16), 4096)) + 1
+
+    def profile(lam):
+        # r, dr/dlam and d^2r/dlam^2 for \lambda of shape (..., G)
+        phase = np.exp(1j*lam[..., :, None]*ts[..., None, :])*Z_est[..., None, :]
+        r = np.mean(phase, axis=-1)
+        dr = np.mean(1j*ts[..., None, :]*phase, axis=-1)
+        d2r = np.mean(-ts[..., None, :]**2*phase, axis=-1)
+        return r, dr, d2r
+
+    grid = np.linspace(0, 1, num_grid)
+    lams = lambda_min[..., None] + (lambda_max - lambda_min)[..., None]*grid
+    r = np.mean(np.exp(1j*lams[..., :, None]*ts[..., None, :])*Z_est[..., None, :], axis=-1)
+    best = np.argmax(np.abs(r)**2, axis=-1)
+    lam = np.take_along_axis(lams, best[..., None], axis=-1)
+    for _ in range(newton_steps):
+        r, dr, d2r = profile(lam)
+        g1 = 2*np.real(np.conj(r)*dr)
+        g2 = 2*(np.abs(dr)**2 + np.real(np.conj(r)*d2r))
+        # only take steps towards a maximum of |r|^2
+        step = np.where(g2 < 0, -g1/np.where(g2 < 0, g2, -1), 0)
+        lam = np.clip(lam + step, lambda_min[..., None], lambda_max[..., None])
+    r, _, _ = profile(lam)
+    r = r[..., 0]
+    lam = lam[..., 0]
+    fun = np.sum(np.abs(Z_est)**2, axis=-1)/NT - np.abs(r)**2
+    return r, lam, fun
+
 def qcels_opt(ts, Z_est, x0, bounds = None, method = 'SLSQP'):
+    """
+    Description: Solve the QCELS least squares problem for (Re r, Im r, \lambda)
+
+    Args: time points: ts;
+    expectation values of time evolution: Z_est;
+    initial guess: x0;
+    bounds on the parameters (only the \lambda bound is used by VARPRO): bounds;
+    solver: method = 'SLSQP' (scipy) or 'VARPRO' (profiled amplitude, grid search and Newton)
+
+    Returns: an OptimizeResult with the fitted parameters in res.x
+    """
+    if method.upper() == 'VARPRO':
+        if bounds:
+            lambda_min, lambda_max = bounds[2]
+        else:
+            # without bounds search one period of the fit around the initial guess
+            dt = ts[1] - ts[0] if len(ts) > 1 else 0
+            half_width = np.pi/dt if dt > 0 else np.pi
+            lambda_min, lambda_max = x0[2] - half_width, x0[2] + half_width
+        r, lam, fun = qcels_varpro(ts, Z_est, lambda_min, lambda_max)
+        return OptimizeResult(x = np.array((r.real, r.imag, lam)), fun = float(fun),
+                              success = True, status = 0, message = 'VARPRO converged')
 
     fun = lambda x: qcels_opt_fun(x, ts, Z_est)
     if( bounds ):
@@ -92,7 +290,7 @@ def qcels_opt(ts, Z_est, x0, bounds = None, method = 'SLSQP'):
 def get_tau(j, time_steps, epsilon, delta):
     return delta*(2**(j - 1 - np.ceil(np.log2(1/epsilon))))/(time_steps*(epsilon))
 
-def qcels_largeoverlap(Z_est, time_steps, lambda_prior, epsilon, delta):
+def qcels_largeoverlap(Z_est, time_steps, lambda_prior, epsilon, delta, method = 'SLSQP'):
     """Multi-level QCELS for a system with a large initial overlap.
 
     Description: The code of using Multi-level QCELS to estimate the ground state energy for a systems with a large initial overlap
@@ -100,7 +298,8 @@ def qcels_largeoverlap(Z_est, time_steps, lambda_prior, epsilon, delta):
     Args: expectation values of time evolution: Z_est; 
     1/precision: T; 
     number of data pairs(time steps): time_steps; 
-    initial guess of \lambda_0: lambda_prior
+    initial guess of \lambda_0: lambda_prior;
+    solver passed to qcels_opt: method = 'SLSQP' ('VARPRO')
 
     Returns: an estimation of \lambda_0: res; 
     total time steps performed: t_ns; 
@@ -112,7 +311,7 @@ def qcels_largeoverlap(Z_est, time_steps, lambda_prior, epsilon, delta):
     print("      Preprocessing", flush = True)
     #Step up and solve the optimization problem
     x0=np.array((0.5,0,lambda_prior))
-    res = qcels_opt(ts, Z_est[0], x0)#Solve the optimization problem
+    res = qcels_opt(ts, Z_est[0], x0, method=method)#Solve the optimization problem
     #Update initial guess for next iteration
     ground_coefficient_QCELS=res.x[0]
     ground_coefficient_QCELS2=res.x[1]
@@ -128,7 +327,7 @@ def qcels_largeoverlap(Z_est, time_steps, lambda_prior, epsilon, delta):
         #Step up and solve the optimization problem
         x0=np.array((ground_coefficient_QCELS,ground_coefficient_QCELS2,ground_energy_estimate_QCELS))
         bnds=((-np.inf,np.inf),(-np.inf,np.inf),(lambda_min,lambda_max)) 
-        res = qcels_opt(ts, Z_est[iter - 1], x0, bounds=bnds)#Solve the optimization problem
+        res = qcels_opt(ts, Z_est[iter - 1], x0, bounds=bnds, method=method)#Solve the optimization problem
         #Update initial guess for next iteration
         ground_coefficient_QCELS=res.x[0]
         ground_coefficient_QCELS2=res.x[1]
@@ -139,7 +338,7 @@ def qcels_largeoverlap(Z_est, time_steps, lambda_prior, epsilon, delta):
     print("      Finished Iterations", flush = True)
     return res, t_ns
 
-def base_qcels_largeoverlap(Z_est, time_steps, lambda_prior, tau):
+def base_qcels_largeoverlap(Z_est, time_steps, lambda_prior, tau, method = 'SLSQP'):
     """Multi-level QCELS for a system with a large initial overlap.
 
     Description: The code of using Multi-level QCELS to estimate the ground state energy for a systems with a large initial overlap
@@ -147,7 +346,8 @@ def base_qcels_largeoverlap(Z_est, time_steps, lambda_prior, tau):
     Args: expectation values of time evolution: Z_est; 
     1/precision: T; 
     number of data pairs(time steps): time_steps; 
-    initial guess of \lambda_0: lambda_prior
+    initial guess of \lambda_0: lambda_prior;
+    solver passed to qcels_opt: method = 'SLSQP' ('VARPRO')
 
     Returns: an estimation of \lambda_0: res.x[2]; 
     """
@@ -155,10 +355,53 @@ def base_qcels_largeoverlap(Z_est, time_steps, lambda_prior, tau):
     print("      Starting Optimization", flush = True)
     #Step up and solve the optimization problem
     x0=np.array((0.5,0,lambda_prior))
-    res = qcels_opt(ts, Z_est, x0)#Solve the optimization problem
+    res = qcels_opt(ts, Z_est, x0, method=method)#Solve the optimization problem
     print("      Finished Optimization")
     return res.x[2]
 
+def qcels_largeoverlap_batch(Z, time_steps, lambda_prior, epsilon, delta, levels = None):
+    """Batched multi-level QCELS for systems with a large initial overlap.
+
+    Description: Runs the same level schedule as qcels_largeoverlap for every batch
+    member at once, solving each level with the variable-projection solver
+    (qcels_varpro) in a single vectorized pass over the batch.
+
+    Args: expectation values of time evolution: Z[batch, level, time_step];
+    number of data pairs(time steps): time_steps;
+    initial guess of \lambda_0 per batch member: lambda_prior;
+    target precision per batch member: epsilon;
+    sqrt(1-p0) per batch member: delta;
+    number of valid levels per batch member: levels (default Z.shape[1], shorter
+    members are zero padded and keep their estimate after their last level)
+
+    Returns: estimations of \lambda_0: est (batch);
+    total time steps performed: t_ns (batch)
+    """
+    Z = np.asarray(Z, dtype=complex)
+    batch, num_levels = Z.shape[0], Z.shape[1]
+    lambda_prior = np.broadcast_to(np.asarray(lambda_prior, dtype=float), (batch,))
+    epsilon = np.broadcast_to(np.asarray(epsilon, dtype=float), (batch,))
+    delta = np.broadcast_to(np.asarray(delta, dtype=float), (batch,))
+    if levels is None:
+        levels = np.full(batch, num_levels)
+    levels = np.broadcast_to(np.asarray(levels), (batch,))
+    t_ns = time_steps*(levels + 1)
+
+    steps = np.arange(time_steps)
+    tau = get_tau(1, time_steps, epsilon, delta)
+    # first level is unbounded: search one period of the fit around the prior
+    _, est, _ = qcels_varpro(tau[:, None]*steps, Z[:, 0, :], lambda_prior - np.pi/tau, lambda_prior + np.pi/tau)
+    lambda_min = est - np.pi/(2*tau)
+    lambda_max = est + np.pi/(2*tau)
+    for iter in range(1, num_levels + 1):
+        tau = get_tau(iter, time_steps, epsilon, delta)
+        _, lam, _ = qcels_varpro(tau[:, None]*steps, Z[:, iter - 1, :], lambda_min, lambda_max)
+        active = iter <= levels
+        est = np.where(active, lam, est)
+        lambda_min = np.where(active, est - np.pi/(2*tau), lambda_min)
+        lambda_max = np.where(active, est + np.pi/(2*tau), lambda_max)
+    return est, t_ns
+
 
 if __name__ == "__main__":
     from matplotlib import pyplot as plt
@@ -197,59 +440,63 @@ if __name__ == "__main__":
 
     # T (TFIM), H (HSM), B (Hubbard), M (H2 molecule)
     model_type = 'T'
-    # Q (Qiskit), F(F3C++)
+    # Q (Qiskit), F(F3C++), P (Qiskit Pauli evolution templates)
     Ham_type = 'F'
+    trotter_reps = 10 # P only: Trotter steps of the evolution templates
+
+    # completed stages are restored from here after a crash or kernel restart
+    run_state = run_checkpoint.RunCheckpoint('Checkpoints/'+model_type+Ham_type+'_n='+str(num_sites))
+    model_config = {'model': model_type, 'Ham': Ham_type, 'n': num_sites, 'shift': ham_shift, 'T': (J_T, g_T),
+                    'H': (J_H, g_H), 'B': (t_H, U_H), 'M': distance, 'trotter_reps': trotter_reps}
+
+    if run_state.done('hamiltonian', model_config):
+        stage = run_state.load('hamiltonian')
+        ham, ground_energy, ground_state, mn = stage['ham'], float(stage['ground_energy']), stage['ground_state'], str(stage['mn'])
+        unitaries = None
+        if model_type[0].upper() == 'M':
+            num_sites = 1
+        print('Restored', mn, 'Hamiltonian from checkpoint')
+    else:
+        if model_type[0].upper() == 'T':
+            mn = 'TFIM'
+            print('Transverse Field Ising Model')
 
-    if model_type[0].upper() == 'T':
-        mn = 'TFIM'
-        print('Transverse Field Ising Model')
-
-        if Ham_type[0].upper() == 'F':
-            unitaries, ham = (generate_TFIM_gates(num_sites, 2, 1, g_T, ham_shift, '../../../f3cpp', trotter = 1000))
-            eigenenergies, eigenenstates = eigh(ham)
-            ground_state = eigenenstates[:,0]
+            if Ham_type[0].upper() == 'F':
+                unitaries, ham = (generate_TFIM_gates(num_sites, 2, 1, g_T, ham_shift, '../../../f3cpp', trotter = 1000, output = 'dense'))
+                ground_energy, ground_state = spectrum.ground_state(ham)
             
-        if Ham_type[0].upper() == 'Q':
-            ham = create_hamiltonian(num_sites, 'TFIM', ham_shift, g = g_T, J=J_T, show_steps=False)
-            eigenenergies, eigenstates = eigh(ham)
-            ground_state = eigenstates[:,0]
-
-            pop = np.abs(np.dot(eigenstates.conj().T, ground_state))**2
+            if Ham_type[0].upper() in ('Q', 'P'):
+                ham = create_hamiltonian(num_sites, 'TFIM', ham_shift, g = g_T, J=J_T, show_steps=False, output = 'dense')
+                ground_energy, ground_state = spectrum.ground_state(ham)
         
-    if model_type[0].upper() == 'H':
-        mn = 'HSM'
-        print('Heisenberg Spin Model')
+        if model_type[0].upper() == 'H':
+            mn = 'HSM'
+            print('Heisenberg Spin Model')
 
-        ham = create_hamiltonian(num_sites, 'SPIN', ham_shift, g = g_H, J=J_H, show_steps=False)
-        eigenenergies, eigenstates = eigh(ham)
-        ground_state = eigenstates[:,0]
+            ham = create_hamiltonian(num_sites, 'SPIN', ham_shift, g = g_H, J=J_H, show_steps=False, output = 'dense')
+            ground_energy, ground_state = spectrum.ground_state(ham)
 
-        pop = np.abs(np.dot(eigenstates.conj().T, ground_state))**2
+        if model_type[0].upper() == 'B':
+            mn = "HUBB"
+            print('Hubbard Model')
 
-    if model_type[0].upper() == 'B':
-        mn = "HUBB"
-        print('Hubbard Model')
+            ham = create_hamiltonian(num_sites, 'HUBB', ham_shift, t = t_H, U=U_H, x = num_sites, y = 1, show_steps=False, output = 'dense')
+            ground_energy, ground_state = spectrum.ground_state(ham)
 
-        ham = create_hamiltonian(num_sites, 'HUBB', ham_shift, t = t_H, U=U_H, x = num_sites, y = 1, show_steps=False)
-        eigenenergies, eigenstates = eigh(ham)
-        ground_state = eigenstates[:,0]
-
-        popp = np.abs(np.dot(eigenstates.conj().T, ground_state))**2
-
-    if model_type[0].upper() == 'M':
-        mn = 'HH'
-        num_sites = 1
-        ang = 0.52917721092
-        print('H2 Molecule')
+        if model_type[0].upper() == 'M':
+            mn = 'HH'
+            num_sites = 1
+            ang = 0.52917721092
+            print('H2 Molecule')
 
-        ham = create_hamiltonian(num_sites, 'H2', ham_shift, show_steps=False)
-        eigenenergies, eigenstates = eigh(ham)
-        ground_state = eigenstates[:,0]
+            ham = create_hamiltonian(num_sites, 'H2', ham_shift, show_steps=False, output = 'dense')
+            ground_energy, ground_state = spectrum.ground_state(ham)
+        # dense ham: checkpointed with np.savez and used by the signal engine and the HT templates
+        run_state.save('hamiltonian', model_config, ham = ham, ground_energy = ground_energy, ground_state = ground_state, mn = mn)
 
-        popp = np.abs(np.dot(eigenstates.conj().T, ground_state))**2
-    
     # initialization: S (Quantum Simulation), or R (Quantum Hardware)
     computation_type = 'S'
+    signal_engine_mode  = True # S only: compute Z(t) analytically instead of running circuits
     output_file = True
     p0_array            = np.array([0.6, 0.8]) # initial overlap with the first eigenvector
     deltas              = np.sqrt(1-p0_array)
@@ -294,271 +541,272 @@ if __name__ == "__main__":
     if output_file:
         outfile = open("Output/"+str(data_name)+"_"+str(mn)+"_trans.txt", 'w')
 
-    ansatz = []
-    for p in range(len(p0_array)):
-        psi = ground_state
-
-        # Generate a random vector orthogonal to psi
-        random_vec = np.random.randn(2**num_sites) + 1j * np.random.randn(2**num_sites)
-        random_vec -= np.vdot(psi, random_vec) * psi  # Make orthogonal to psi
-        random_vec /= np.linalg.norm(random_vec)  # Normalize
-
-        # Construct psi with the required squared overlap
-        overlap_squared = p0_array[p]
-        phi = np.sqrt(overlap_squared) * psi + np.sqrt(1 - overlap_squared) * random_vec
-
-        print(np.abs(np.vdot(psi, phi))**2)
-        ansatz.append(phi)
-
-    # Create and run HT for lambda_prior
+    # transpiled circuits keyed by unitary, ansatz, W, backend and optimization level
+    HT_cache = circuit_cache.CircuitCache('Transpiled_Circuits/HT_cache.qpy', max_bytes = 2**30)
 
-    circs = []
-    if Ham_type[0].upper() == 'F':
-        print('F3C++')
-        for p in range(len(p0_array)):
-            trans_qc1 = create_HT_circuit(num_sites, unitaries[-1], W = 'Re', backend = backend, init_state = ansatz[p])
-            trans_qc2 = create_HT_circuit(num_sites, unitaries[-1], W = 'Im', backend = backend, init_state = ansatz[p])
-            
-
-            circs.append(trans_qc1)
-            circs.append(trans_qc2)
-
-        sampler = Sampler(backend)
-        job = sampler.run(circs, shots = 10000)
-        lambda_results = job.result()
+    run_config = dict(model_config, computation = computation_type, backend = backend.name, p0 = p0_array, trials = trials,
+                      tests = tests, shots = T0, time_steps = time_steps, iterations = iterations)
+    ansatz_config = dict(model_config, p0 = p0_array)
 
-    if Ham_type[0].upper() == 'Q':
-        print('Qiskit')
+    if run_state.done('ansatz', ansatz_config):
+        ansatz = list(run_state.load('ansatz')['ansatz'])
+    else:
+        ansatz = []
         for p in range(len(p0_array)):
-            mat = expm(-1j*ham)
-            controlled_U = UnitaryGate(mat).control(annotated="yes")
+            psi = ground_state
 
-            trans_qc1 = create_HT_circuit(num_sites, controlled_U, W = 'Re', backend = backend, init_state = ansatz[p])
-            trans_qc2 = create_HT_circuit(num_sites, controlled_U, W = 'Im', backend = backend, init_state = ansatz[p])
+            # Generate a random vector orthogonal to psi
+            random_vec = np.random.randn(2**num_sites) + 1j * np.random.randn(2**num_sites)
+            random_vec -= np.vdot(psi, random_vec) * psi  # Make orthogonal to psi
+            random_vec /= np.linalg.norm(random_vec)  # Normalize
 
-            circs.append(trans_qc1)
-            circs.append(trans_qc2)
+            # Construct psi with the required squared overlap
+            overlap_squared = p0_array[p]
+            phi = np.sqrt(overlap_squared) * psi + np.sqrt(1 - overlap_squared) * random_vec
 
-        sampler = Sampler(backend)
-        job = sampler.run(circs, shots = 10000)
-        lambda_results = job.result()
+            print(np.abs(np.vdot(psi, phi))**2)
+            ansatz.append(phi)
+        run_state.save('ansatz', ansatz_config, ansatz = np.array(ansatz))
 
-    # Get lambda_prior
-    lambda_priors = []
+    if computation_type[0].upper() == 'S' and signal_engine_mode:
+        print('Analytic signal engine')
+        lambda_priors = []
+        Z_ests = []
+        for p in range(len(p0_array)):
+            energies, weights = signal_engine.spectral_weights(ham, ansatz[p])
+            Z_prior = signal_engine.sample_Z(np.array([1.0]), energies, weights, 10000)[0]
 
-    re_data1 = lambda_results[0].data
-    im_data1 = lambda_results[1].data
+            Angle = np.arccos(Z_prior.real)
+            if  np.arcsin(Z_prior.imag)<0:
+                Phase = 2*np.pi - Angle
+            else:
+                Phase = Angle
+            lambda_priors.append(-Phase)
 
-    re_data2 = lambda_results[2].data
-    im_data2 = lambda_results[3].data
+            taus = [[get_tau(j, time_steps, epsilons[trial], deltas[p]) for j in range(iterations[trial] + 1)] for trial in range(trials)]
+            Z_ests.append(signal_engine.sample_Z_ests(energies, weights, taus, time_steps, tests, T0))
 
+        print('lambda_priors: ', lambda_priors, '\n target: ', ground_energy)
 
-    counts_re1 = re_data1[list(re_data1.keys())[0]].get_counts()
-    counts_im1 = im_data1[list(im_data1.keys())[0]].get_counts()
+    else:
+        # P only: transpiled once per (p0, W) when a stage first needs them (checkpointed stages
+        # never do) and reused for every evolution time below
+        templates = {}
+        def HT_templates(p):
+            if p not in templates:
+                templates[p] = [create_HT_template(num_sites, ham, W = W, backend = backend, init_state = ansatz[p], reps = trotter_reps) for W in ('Re', 'Im')]
+            return templates[p]
+
+        if run_state.done('lambda_priors', run_config):
+            lambda_priors = run_state.load('lambda_priors')['lambda_priors'].tolist()
+        else:
+            # Create and run HT for lambda_prior
+
+            circs = []
+            if Ham_type[0].upper() == 'F':
+                print('F3C++')
+                if unitaries is None: # Hamiltonian restored from a checkpoint
+                    unitaries, _ = (generate_TFIM_gates(num_sites, 2, 1, g_T, ham_shift, '../../../f3cpp', trotter = 1000))
+                for p in range(len(p0_array)):
+                    trans_qc1 = create_HT_circuit(num_sites, unitaries[-1], W = 'Re', backend = backend, init_state = ansatz[p], cache = HT_cache)
+                    trans_qc2 = create_HT_circuit(num_sites, unitaries[-1], W = 'Im', backend = backend, init_state = ansatz[p], cache = HT_cache)
+                
 
-    counts_re2 = re_data2[list(re_data2.keys())[0]].get_counts()
-    counts_im2 = im_data2[list(im_data2.keys())[0]].get_counts()
+                    circs.append(trans_qc1)
+                    circs.append(trans_qc2)
 
+            if Ham_type[0].upper() == 'Q':
+                print('Qiskit')
+                mat = signal_engine.evolution_operators(ham, [1.0])[0]
+                for p in range(len(p0_array)):
+                    controlled_U = UnitaryGate(mat).control(annotated="yes")
 
-    re_p0 = im_p0 = 0
-    if counts_re1.get('0') is not None:
-        re_p0 = counts_re1['0']/10000
-    if counts_im1.get('0') is not None:
-        im_p0 = counts_im1['0']/10000
+                    trans_qc1 = create_HT_circuit(num_sites, controlled_U, W = 'Re', backend = backend, init_state = ansatz[p], cache = HT_cache)
+                    trans_qc2 = create_HT_circuit(num_sites, controlled_U, W = 'Im', backend = backend, init_state = ansatz[p], cache = HT_cache)
 
-    Re = 2*re_p0 - 1
-    Im = 2*im_p0 - 1
+                    circs.append(trans_qc1)
+                    circs.append(trans_qc2)
 
-    Angle = np.arccos(Re)
-    if  np.arcsin(Im)<0:
-        Phase = 2*np.pi - Angle
-    else:
-        Phase = Angle
+            if Ham_type[0].upper() == 'P':
+                print('Qiskit templates')
+                for p in range(len(p0_array)):
+                    circs.append(bind_HT_template(HT_templates(p)[0], 1))
+                    circs.append(bind_HT_template(HT_templates(p)[1], 1))
 
-    lambda_prior = -Phase
-    lambda_priors.append(lambda_prior)
+            sampler = Sampler(backend)
+            job = sampler.run(circs, shots = 10000)
+            lambda_results = job.result()
 
+            # Get lambda_prior
+            lambda_priors = []
+            lambda_p0 = result_manifest.decode_p0(lambda_results)
+            for p in range(len(p0_array)):
+                Re = 2*lambda_p0[2*p] - 1
+                Im = 2*lambda_p0[2*p + 1] - 1
 
-    re_p0 = im_p0 = 0
-    if counts_re2.get('0') is not None:
-        re_p0 = counts_re2['0']/10000
-    if counts_im2.get('0') is not None:
-        im_p0 = counts_im2['0']/10000
+                Angle = np.arccos(Re)
+                if  np.arcsin(Im)<0:
+                    Phase = 2*np.pi - Angle
+                else:
+                    Phase = Angle
 
-    Re = 2*re_p0 - 1
-    Im = 2*im_p0 - 1
+                lambda_prior = -Phase
+                lambda_priors.append(lambda_prior)
+            run_state.save('lambda_priors', run_config, lambda_priors = np.array(lambda_priors))
 
-    Angle = np.arccos(Re)
-    if  np.arcsin(Im)<0:
-        Phase = 2*np.pi - Angle
-    else:
-        Phase = Angle
+        print('lambda_priors: ', lambda_priors, '\n target: ', ground_energy)
 
-    lambda_prior = -Phase
-    lambda_priors.append(lambda_prior)
+        if Ham_type[0].upper() == 'F':
+            TFIM_provider = TFIMGateProvider(num_sites, g_T, ham_shift, '../../../f3cpp', trotter = 1000)
 
-    print('lambda_priors: ', lambda_priors, '\n target: ', eigenenergies[0])
+        # Collects every circuit spec of p0 and records what it measures (test 0) in the manifest
+        def collect_QCELS_specs(p):
+            p0=p0_array[p]
+            delta = deltas[p]
+            circuit_specs = []
+            circuit_files = []
+            manifest = result_manifest.CircuitManifest()
 
-    # Transpiles circuits
-    times = []
-    for p in range(len(p0_array)):
-        p0=p0_array[p]
-        delta = deltas[p]
+            print("Testing p0 =", p0,"("+str(p+1)+"/"+str(len(p0_array))+")")
 
-        print("Testing p0 =", p0,"("+str(p+1)+"/"+str(len(p0_array))+")")
+            if output_file: print("Testing p0 =", p0,"("+str(p+1)+"/"+str(len(p0_array))+")", file = outfile)
 
-        if output_file: print("Testing p0 =", p0,"("+str(p+1)+"/"+str(len(p0_array))+")", file = outfile)
+            print("  Generating QCELS circuits", "(p0="+str(p0)+")")
 
-        print("  Generating QCELS circuits", "(p0="+str(p0)+")")
+            if Ham_type[0].upper() == 'F':
+                # every distinct tau of p0, each generated once on its own Trotter grid
+                TFIM_gates = TFIM_provider.gates([get_tau(j, time_steps, epsilons[trial], delta) for trial in range(trials) for j in range(iterations[trial] + 1)], time_steps)
 
-        #------------------QCELS-----------------
-        for trial in range(trials):
-            print("    Transpiling QCELS", "("+str(trial+1)+"/"+str(trials)+")")
+            #------------------QCELS-----------------
+            for trial in range(trials):
+                print("    Preparing QCELS", "("+str(trial+1)+"/"+str(trials)+")")
             
-            if output_file: print("    Transpiling QCELS", "("+str(trial+1)+"/"+str(trials)+")", file = outfile, flush = True)
-
-            epsilon = epsilons[trial]
-            for j in range(iterations[trial] + 1):
-                tau = get_tau(j, time_steps, epsilon, delta)
-                qcs_QCELS = []
-                if Ham_type[0].upper() == 'F':
-                    unitaries, _ = (generate_TFIM_gates(num_sites, time_steps, tau, g_T, ham_shift, '../../../f3cpp', trotter = 1000))
-                for data_pair in range(time_steps):
-                    if Ham_type[0].upper() == 'Q':
-                        t = tau*data_pair
-                        mat = expm(-1j*ham*t)
-                        times.append(t)
-                        controlled_U = UnitaryGate(mat).control(annotated="yes")
-                        qcs_QCELS.append(create_HT_circuit(num_sites, controlled_U, W = 'Re', backend = backend, init_state = ansatz[p]))
-                        qcs_QCELS.append(create_HT_circuit(num_sites, controlled_U, W = 'Im', backend = backend, init_state = ansatz[p]))
+                if output_file: print("    Preparing QCELS", "("+str(trial+1)+"/"+str(trials)+")", file = outfile, flush = True)
+
+                epsilon = epsilons[trial]
+                for j in range(iterations[trial] + 1):
+                    tau = get_tau(j, time_steps, epsilon, delta)
+                    start = len(circuit_specs)
                     if Ham_type[0].upper() == 'F':
-                        qcs_QCELS.append(create_HT_circuit(num_sites, unitaries[data_pair], W = 'Re', backend = backend, init_state = ansatz[p]))
-                        qcs_QCELS.append(create_HT_circuit(num_sites, unitaries[data_pair], W = 'Im', backend = backend, init_state = ansatz[p]))
-                    
-                with open('Transpiled_Circuits/QCELS_p0='+str(p0)+'_Trial'+str(trial)+'_Iter='+str(j)+'.qpy', 'wb') as f:
-                    qiskit.qpy.dump(qcs_QCELS, f)
-        print('Finished transpiling for QCELS ', "(p0="+str(p0)+")")
-    
-    # Loads transpiled circuits
-    qcs_QCELS = []
+                        unitaries = TFIM_gates[tau]
+                    if Ham_type[0].upper() == 'Q':
+                        mats = signal_engine.evolution_operators(ham, tau*np.arange(time_steps))
+                    for data_pair in range(time_steps):
+                        if Ham_type[0].upper() == 'Q':
+                            controlled_U = UnitaryGate(mats[data_pair]).control(annotated="yes")
+                            circuit_specs.append((num_sites, controlled_U, 'Re', ansatz[p]))
+                            circuit_specs.append((num_sites, controlled_U, 'Im', ansatz[p]))
+                        if Ham_type[0].upper() == 'F':
+                            circuit_specs.append((num_sites, unitaries[data_pair], 'Re', ansatz[p]))
+                            circuit_specs.append((num_sites, unitaries[data_pair], 'Im', ansatz[p]))
+                        if Ham_type[0].upper() == 'P':
+                            t = tau*data_pair
+                            circuit_specs.append(bind_HT_template(HT_templates(p)[0], t))
+                            circuit_specs.append(bind_HT_template(HT_templates(p)[1], t))
+                        manifest.add(p, 0, trial, j, data_pair, 'Re')
+                        manifest.add(p, 0, trial, j, data_pair, 'Im')
+
+                    circuit_files.append(('Transpiled_Circuits/QCELS_p0='+str(p0)+'_Trial'+str(trial)+'_Iter='+str(j)+'.qpy', start, len(circuit_specs)))
+            return circuit_specs, circuit_files, manifest
+
+        # One chunk per p0: generates, transpiles and saves the circuits of p0 (or restores them
+        # from the checkpoint) and repeats them for every test
+        def prepare_QCELS(p):
+            stage = 'QCELS_circuits_p'+str(p)
+            if run_state.done(stage, run_config):
+                return run_state.load_circuits(stage)*tests
+            circuit_specs, circuit_files, manifest = collect_QCELS_specs(p)
+            print("  Transpiling", len(circuit_specs), "QCELS circuits (p0="+str(p0_array[p])+")")
+            if output_file: print("  Transpiling", len(circuit_specs), "QCELS circuits (p0="+str(p0_array[p])+")", file = outfile, flush = True)
+            trans_QCELS = transpile_HT_circuits(circuit_specs, backend = backend, cache = HT_cache)
+            for file_name, start, stop in circuit_files:
+                with open(file_name, 'wb') as f:
+                    qiskit.qpy.dump(trans_QCELS[start:stop], f)
+            # saved before the circuits, so every chunk marked as prepared has its manifest
+            run_state.save(stage+'_manifest', run_config, records = manifest.as_array())
+            run_state.save_circuits(stage, trans_QCELS, run_config)
+            return trans_QCELS*tests
+
+        # Manifest of the chunk of p0, with the records of one test repeated like its circuits
+        def QCELS_manifest(p):
+            records = run_state.load('QCELS_circuits_p'+str(p)+'_manifest')['records']
+            manifest = result_manifest.CircuitManifest()
+            for test in range(tests):
+                records['test'] = test
+                manifest.extend(result_manifest.CircuitManifest(records))
+            return manifest
+
+        if run_state.done('Z', run_config):
+            Z_dense = run_state.load('Z')['Z']
+        else:
+            # Transpiles the next p0 while the current one is submitted and earlier jobs run;
+            # chunks collected before a restart are restored and submitted jobs are polled again
+            print('Running transpiled circuits')
+            sampler = Sampler(backend)
+            retrieve = (lambda job_id: get_q_job(job_id, service)) if computation_type[0].upper() == 'R' else None
+            p0s = run_checkpoint.run_chunks(run_state, 'QCELS', run_config, list(range(len(p0_array))), sampler, T0,
+                                            prepare = prepare_QCELS, retrieve = retrieve, max_pending = 2)
+            print('Finished running QCELS circuits')
+
+            manifest = result_manifest.CircuitManifest()
+            for p in range(len(p0_array)):
+                manifest.extend(QCELS_manifest(p))
+            Z_dense = result_manifest.scatter_Z(np.concatenate(p0s), manifest, shape = (len(p0_array), tests, trials, max(iterations) + 1, time_steps))
+            run_state.save('Z', run_config, Z = Z_dense)
+        Z_ests = result_manifest.nested_Z_ests(Z_dense, iterations)
 
+    if output_file:
+        outfile = open("Output/"+str(data_name)+"_"+str(mn)+"_run.txt", 'w')
+
+    # Solve every (p0, test, trial) combination in one batched pass
+    max_levels = max(iterations) + 1
+    Z_batch = np.zeros((len(p0_array), tests, trials, max_levels, time_steps), dtype=complex)
+    levels_batch = np.zeros((len(p0_array), tests, trials), dtype=int)
     for p in range(len(p0_array)):
-        p0 = p0_array[p]
-        print("Loading p0 =", p0,"("+str(p+1)+"/"+str(len(p0_array))+")")
-        for test in range(tests):
-            print("  Test", str(test + 1) + '/' + str(tests))
-            for trial in range(trials):
-                print('    Loading QCELS data ('+str(trial+1)+'/'+str(trials)+')')
-                for i in range(iterations[trial] + 1):
-                    with open('Transpiled_Circuits/QCELS_p0='+str(p0)+'_Trial'+str(trial)+'_Iter='+str(i)+'.qpy', 'rb') as f:
-                        circs = qiskit.qpy.load(f)
-                        qcs_QCELS.append(circs)
-
-    qcs_QCELS = sum(qcs_QCELS, []) # flatten list
-
-    num_splits = 1
-    split = int(len(qcs_QCELS)/num_splits)
-
-    qcs_QCELS_circuits = []
-    for i in range(num_splits):
-        qcs_QCELS_circuits.append(qcs_QCELS[i*split:(i+1)*split])
-
-    # Runs loaded circuits
-    print('Running transpiled circuits')
-    sampler = Sampler(backend)
-    jobs = []
-    results = []
-    for i in range(num_splits):
-        job = sampler.run(qcs_QCELS_circuits[i], shots = T0)
-        result = job.result()
-        jobs.append(job)
-        results.append(result)
-    results = flatten(results)
-
-    # results = list(get_q_job('d0wcfkphtw7g008py6vg', service))
-
-    Z_ests = []
-    for p in range(len(p0_array)):
-        Z_ests.append([])
         for test in range(tests):
-            Z_ests[p].append([])
             for trial in range(trials):
-                Z_ests[p][test].append([])
-                for iter in range(iterations[trial] + 1):
-                    Z_ests[p][test][trial].append([])
-                    for time_step in range(time_steps):
-                        index = time_step*2 + iter*time_steps*2 + (sum(iterations[0:trial])+trial)*time_steps*2 + test*(sum(iterations)+len(iterations))*time_steps*2 + p*tests*(sum(iterations)+len(iterations))*time_steps*2
-                        raw_data_re = results[index].data
-                        counts_re = raw_data_re[list(raw_data_re.keys())[0]].get_counts()
-                        raw_data_im = results[index + 1].data
-                        counts_im = raw_data_im[list(raw_data_im.keys())[0]].get_counts()
-
-                        re_p0 = im_p0 = 0
-                        if counts_re.get('0') is not None:
-                            re_p0 = counts_re['0']/T0
-                        if counts_im.get('0') is not None:
-                            im_p0 = counts_im['0']/T0
-                        
-                        Re = 2*re_p0-1
-                        Im = 2*im_p0-1 
-
-                        Z_est = complex(Re,Im)
-                        Z_ests[p][test][trial][iter].append(Z_est)
-
-    if output_file:
-        outfile = open("Output/"+str(data_name)+"_"+str(mn)+"_run.txt", 'w')
+                levels_batch[p, test, trial] = iterations[trial] + 1
+                Z_batch[p, test, trial, :iterations[trial] + 1] = Z_ests[p][test][trial]
+    lambda_batch = np.broadcast_to(np.array(lambda_priors)[:, None, None], levels_batch.shape)
+    epsilon_batch = np.broadcast_to(np.array(epsilons)[None, None, :], levels_batch.shape)
+    delta_batch = np.broadcast_to(deltas[:, None, None], levels_batch.shape)
+
+    print("Running batched QCELS")
+    est_batch, t_ns_batch = qcels_largeoverlap_batch(Z_batch.reshape((-1, max_levels, time_steps)), time_steps,
+                                                     lambda_batch.ravel(), epsilon_batch.ravel(), delta_batch.ravel(),
+                                                     levels = levels_batch.ravel())
+    est_batch = est_batch.reshape(levels_batch.shape)
+    t_ns_batch = t_ns_batch.reshape(levels_batch.shape)
+    err_batch = np.abs(est_batch - ground_energy)
 
     for p in range(len(p0_array)):
         p0=p0_array[p]
-        lambda_prior = lambda_priors[p]
-        delta = deltas[p]
-        
-        n_success_QCELS= np.zeros(trials)
 
         print("Testing p0 =", p0,"("+str(p+1)+"/"+str(len(p0_array))+")")
 
         if output_file: print("Testing p0 =", p0,"("+str(p+1)+"/"+str(len(p0_array))+")", file = outfile)
 
         for test in range(tests):
-
-            print("  Generating QCELS data", "(p0="+str(p0)+")","("+str(test+1)+"/"+str(tests)+")")
-            #------------------QCELS-----------------
             for trial in range(trials):
-                print("    Running QCELS", "("+str(trial+1)+"/"+str(trials)+")")
-
                 if output_file: print("    Running QCELS", "("+str(trial+1)+"/"+str(trials)+")", file = outfile, flush = True)
-                epsilon = epsilons[trial]
-                ground_energy_estimate_QCELS, cosT_depth_list_this = qcels_largeoverlap(Z_ests[p][test][trial], time_steps, lambda_prior, epsilon, delta) # add [test] index
-                est_this_run_QCELS = ground_energy_estimate_QCELS.x[2] 
-
-                if output_file: print("      Estimated ground state energy =", est_this_run_QCELS, file = outfile)
-                
-                err_this_run_QCELS = np.abs(est_this_run_QCELS - eigenenergies[0])
-                err_QCELS[p,trial] = err_QCELS[p,trial] + np.abs(err_this_run_QCELS)
-                est_QCELS[p,trial] = est_QCELS[p,trial] + est_this_run_QCELS
-                cost_list_avg_QCELS[p,trial] = cost_list_avg_QCELS[p,trial] + cosT_depth_list_this
-
-                if np.abs(err_this_run_QCELS)<err_threshold:
-                    n_success_QCELS[trial]+=1
+                if output_file: print("      Estimated ground state energy =", est_batch[p, test, trial], file = outfile)
 
-            print("    Finished QCELS data\n")
             if output_file: print("    Finished QCELS data\n", file = outfile)
 
-        rate_success_QCELS[p,:] = n_success_QCELS[:]/tests
-        err_QCELS[p,:] = err_QCELS[p,:]/tests
-        est_QCELS[p,:] = est_QCELS[p,:]/tests
-        #cost_list_avg_QCELS[p,:]=cost_list_avg_QCELS[p,:]/tests
-        cost_list_avg_QCELS[p,:]=2*cost_list_avg_QCELS[p,:]/tests # total shots instead of time steps (dont multiply by T0 for observables)
+    rate_success_QCELS[:,:] = np.mean(err_batch<err_threshold, axis = 1)
+    err_QCELS[:,:] = np.mean(err_batch, axis = 1)
+    est_QCELS[:,:] = np.mean(est_batch, axis = 1)
+    cost_list_avg_QCELS[:,:] = 2*np.mean(t_ns_batch, axis = 1) # total shots instead of time steps (dont multiply by T0 for observables)
 
 
     if model_type[0].upper() == 'T':
-        np.savez('Data/'+data_name+'_result_TFIM_'+str(num_sites)+'sites_QCELS_long',name1=rate_success_QCELS,name2=cost_list_avg_QCELS,name3=err_QCELS,name4=est_QCELS,name5=eigenenergies[0],name6=p0_array)
+        np.savez('Data/'+data_name+'_result_TFIM_'+str(num_sites)+'sites_QCELS_long',name1=rate_success_QCELS,name2=cost_list_avg_QCELS,name3=err_QCELS,name4=est_QCELS,name5=ground_energy,name6=p0_array)
     if model_type[0].upper() == 'H':
-        np.savez('Data/'+data_name+'_result_HSM_'+str(num_sites)+'sites_QCELS_long',name1=rate_success_QCELS,name2=cost_list_avg_QCELS,name3=err_QCELS,name4=est_QCELS,name5=eigenenergies[0],name6=p0_array)
+        np.savez('Data/'+data_name+'_result_HSM_'+str(num_sites)+'sites_QCELS_long',name1=rate_success_QCELS,name2=cost_list_avg_QCELS,name3=err_QCELS,name4=est_QCELS,name5=ground_energy,name6=p0_array)
     if model_type[0].upper() == 'B':
-        np.savez('Data/'+data_name+'_result_HUBB_'+str(num_sites)+'sites_QCELS_long',name1=rate_success_QCELS,name2=cost_list_avg_QCELS,name3=err_QCELS,name4=est_QCELS,name5=eigenenergies[0],name6=p0_array)
+        np.savez('Data/'+data_name+'_result_HUBB_'+str(num_sites)+'sites_QCELS_long',name1=rate_success_QCELS,name2=cost_list_avg_QCELS,name3=err_QCELS,name4=est_QCELS,name5=ground_energy,name6=p0_array)
     if model_type[0].upper() == 'M':
-        np.savez('Data/'+data_name+'_result_HH_'+str(num_sites)+'sites_QCELS_long',name1=rate_success_QCELS,name2=cost_list_avg_QCELS,name3=err_QCELS,name4=est_QCELS,name5=eigenenergies[0],name6=p0_array)
+        np.savez('Data/'+data_name+'_result_HH_'+str(num_sites)+'sites_QCELS_long',name1=rate_success_QCELS,name2=cost_list_avg_QCELS,name3=err_QCELS,name4=est_QCELS,name5=ground_energy,name6=p0_array)
 
     print("Saved data to files starting with", data_name)
     if output_file: print("Saved data to files starting with", data_name, file = outfile, flush=True)
@@ -0,0 +1,110 @@
+""" Circuit manifest and vectorized decoding of Hadamard test results
+
+Every Hadamard test circuit is recorded in a CircuitManifest as
+(p, test, trial, level, time_step, W) when it is created or loaded, in the
+same order as the circuits are submitted. decode_Z then reads the SamplerV2
+BitArray payloads straight into NumPy and scatters the Re/Im estimates into
+a dense Z[p, test, trial, level, time_step] array, so no index formula has
+to mirror the submission layout.
+"""
+import numpy as np
+
+manifest_dtype = np.dtype([('p', np.int32), ('test', np.int32), ('trial', np.int32),
+                           ('level', np.int32), ('time_step', np.int32), ('W', np.int8)])
+
+
+class CircuitManifest:
+    """
+    Description: Ordered record of what each submitted circuit measures. W is stored as
+    0 for the real and 1 for the imaginary Hadamard test; p indexes p0_array.
+    """
+
+    def __init__(self, records = None):
+        self.records = [] if records is None else [tuple(r) for r in records]
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, p, test, trial, level, time_step, W):
+        self.records.append((p, test, trial, level, time_step, 0 if W[0].upper() == 'R' else 1))
+
+    def extend(self, other):
+        self.records.extend(other.records)
+
+    def as_array(self):
+        return np.array(self.records, dtype = manifest_dtype)
+
+    def save(self, path):
+        np.save(path, self.as_array())
+
+    @classmethod
+    def load(cls, path):
+        return cls(np.load(path).tolist())
+
+
+def decode_p0(results):
+    """
+    Description: Fraction of shots with ancilla outcome 0 for every pub result, read from
+    the BitArray payloads (clbit 0 is the lowest bit of the last byte)
+
+    Args: list of SamplerV2 pub results: results
+
+    Returns: array of length len(results)
+    """
+    arrays = []
+    for result in results:
+        data = result.data
+        arrays.append(data[list(data.keys())[0]].array)
+    if len({a.shape for a in arrays}) == 1:
+        bits = np.stack(arrays)[..., -1] & 1
+        return 1 - bits.mean(axis = -1)
+    return np.array([1 - np.mean(a[..., -1] & 1) for a in arrays])
+
+
+def decode_Z(results, manifest, shape = None):
+    """
+    Description: Dense Z estimates (2*re_p0 - 1) + 1j*(2*im_p0 - 1) from Hadamard test results
+
+    Args: list of SamplerV2 pub results in manifest order: results;
+    CircuitManifest of the submitted circuits: manifest;
+    shape (p, test, trial, level, time_step) of the output: shape (default from the manifest)
+
+    Returns: complex array Z[p, test, trial, level, time_step], zero where nothing was measured
+    """
+    return scatter_Z(decode_p0(results), manifest, shape)
+
+
+def scatter_Z(p0, manifest, shape = None):
+    """
+    Description: Dense Z estimates from already decoded P(0) fractions (e.g. restored from a checkpoint)
+
+    Args: P(0) of every circuit in manifest order: p0;
+    CircuitManifest of the submitted circuits: manifest;
+    shape (p, test, trial, level, time_step) of the output: shape (default from the manifest)
+
+    Returns: complex array Z[p, test, trial, level, time_step], zero where nothing was measured
+    """
+    records = manifest.as_array()
+    assert len(records) == len(p0)
+    if shape is None:
+        shape = tuple(int(records[name].max()) + 1 for name in manifest_dtype.names[:-1])
+    values = 2*np.asarray(p0) - 1
+    index = tuple(records[name] for name in manifest_dtype.names[:-1])
+    Z = np.zeros(shape, dtype = complex)
+    is_re = records['W'] == 0
+    Z.real[tuple(i[is_re] for i in index)] = values[is_re]
+    Z.imag[tuple(i[~is_re] for i in index)] = values[~is_re]
+    return Z
+
+
+def nested_Z_ests(Z, iterations):
+    """
+    Description: Convert dense Z[p, test, trial, level, time_step] to the nested
+    Z_ests[p][test][trial][iter] lists of the qcels.py driver
+
+    Args: dense estimates: Z; iterations per trial (trial has iterations[trial]+1 levels): iterations
+
+    Returns: nested lists of complex estimates
+    """
+    return [[[[list(Z[p, test, trial, iter]) for iter in range(iterations[trial] + 1)]
+              for trial in range(Z.shape[2])] for test in range(Z.shape[1])] for p in range(Z.shape[0])]
@@ -0,0 +1,138 @@
+""" Checkpointed, resumable QCELS experiment runs
+
+A RunCheckpoint directory holds one .npz file per completed stage
+(Hamiltonian and spectrum, ansatz, lambda priors, decoded chunks, Z), qpy
+files of transpiled circuits, and a state.json that maps every stage to a
+fingerprint of the configuration it was computed with and records the job
+ids of submitted chunks. A stage only counts as done when its fingerprint
+matches, so changing a parameter recomputes the affected stages instead of
+silently reusing stale data.
+"""
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+import qiskit
+
+import pipeline
+import result_manifest
+from cache_utils import atomic_write
+
+
+def fingerprint(config):
+    """ Hash of a json-serializable configuration (numpy values are converted) """
+    text = json.dumps(config, sort_keys = True, default = lambda x: np.asarray(x).tolist())
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class RunCheckpoint:
+    """
+    Description: Directory of completed stages, transpiled circuits and submitted job ids
+
+    Args: checkpoint directory: directory
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.state_path = os.path.join(directory, 'state.json')
+        self.state = {'stages': {}, 'jobs': {}}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok = True)
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r') as f:
+                self.state = json.load(f)
+
+    def _path(self, name, extension):
+        return os.path.join(self.directory, name + extension)
+
+    def _write_state(self):
+        with atomic_write(self.state_path, 'w') as f:
+            json.dump(self.state, f, indent = 1)
+
+    def done(self, stage, config = None):
+        """True if stage was saved with the same configuration."""
+        return self.state['stages'].get(stage) == fingerprint(config)
+
+    def save(self, stage, config = None, **arrays):
+        """Store the arrays of a stage and mark it as done for config."""
+        with atomic_write(self._path(stage, '.npz')) as f:
+            np.savez(f, **arrays)
+        with self.lock:
+            self.state['stages'][stage] = fingerprint(config)
+            self._write_state()
+
+    def load(self, stage):
+        """Arrays of a completed stage as a dict."""
+        with np.load(self._path(stage, '.npz')) as data:
+            return {key: data[key] for key in data.files}
+
+    def save_circuits(self, stage, circuits, config = None):
+        with atomic_write(self._path(stage, '.qpy')) as f:
+            qiskit.qpy.dump(circuits, f)
+        with self.lock:
+            self.state['stages'][stage] = fingerprint(config)
+            self._write_state()
+
+    def load_circuits(self, stage):
+        with open(self._path(stage, '.qpy'), 'rb') as f:
+            return qiskit.qpy.load(f)
+
+    def record_job(self, stage, k, job_id, config = None):
+        """Remember the job id of chunk k of stage."""
+        with self.lock:
+            jobs = self.state['jobs'].get(stage)
+            if jobs is None or jobs['config'] != fingerprint(config):
+                jobs = self.state['jobs'][stage] = {'config': fingerprint(config), 'ids': {}}
+            jobs['ids'][str(k)] = job_id
+            self._write_state()
+
+    def job_ids(self, stage, config = None):
+        """Recorded job ids {chunk: job_id} of stage for config."""
+        jobs = self.state['jobs'].get(stage)
+        if jobs is None or jobs['config'] != fingerprint(config):
+            return {}
+        return {int(k): job_id for k, job_id in jobs['ids'].items()}
+
+
+def run_chunks(run_state, stage, config, chunks, sampler, shots, prepare = None, retrieve = None, max_pending = 2):
+    """
+    Description: Resumable run_pipeline. Chunks decoded in an earlier run are loaded, chunks
+    whose job was submitted but never collected are polled through retrieve, and only the
+    remaining ones are prepared and submitted. Every decoded chunk is saved as soon as it arrives.
+
+    Args: RunCheckpoint: run_state; stage name: stage; configuration of the stage: config;
+    list of chunks: chunks; SamplerV2: sampler; shots per circuit: shots;
+    callable turning a chunk into circuits: prepare;
+    callable(job_id) returning the PrimitiveResult of a submitted job, or None when jobs
+    cannot be retrieved (e.g. local simulators): retrieve;
+    maximum number of uncollected jobs: max_pending
+
+    Returns: list of P(0) arrays (one entry per circuit) in chunk order
+    """
+    names = [stage + '_chunk' + str(k) for k in range(len(chunks))]
+    job_ids = run_state.job_ids(stage, config)
+    p0s = [None]*len(chunks)
+    todo = []
+    for k in range(len(chunks)):
+        if run_state.done(names[k], config):
+            p0s[k] = run_state.load(names[k])['p0']
+        elif retrieve is not None and k in job_ids:
+            print('  Collecting job', job_ids[k], '(chunk '+str(k)+')')
+            p0s[k] = result_manifest.decode_p0(retrieve(job_ids[k]))
+            run_state.save(names[k], config, p0 = p0s[k])
+        else:
+            todo.append(k)
+
+    def on_submit(i, job):
+        run_state.record_job(stage, todo[i], job.job_id(), config)
+
+    def on_result(i, result):
+        p0s[todo[i]] = result_manifest.decode_p0(result)
+        run_state.save(names[todo[i]], config, p0 = p0s[todo[i]])
+
+    if todo:
+        pipeline.run_pipeline([chunks[k] for k in todo], sampler, shots, prepare = prepare, max_pending = max_pending,
+                              on_submit = on_submit, on_result = on_result)
+    return p0s
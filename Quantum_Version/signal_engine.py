@@ -0,0 +1,127 @@
+""" Analytic Hadamard-test signals for simulation mode
+
+In a noiseless simulation the Hadamard test only estimates
+Z(t) = <phi|exp(-iHt)|phi>. Diagonalizing H once gives
+Z(t) = sum_k |<psi_k|phi>|^2 exp(-i E_k t) for any batch of times, and the
+shot noise of the Re and Im tests is a binomial draw with
+P(0) = (1 + Re Z)/2 and P(0) = (1 + Im Z)/2 respectively.
+
+The same eigendecomposition, cached by a hash of the matrix, also gives
+the circuit path's time evolution operators V diag(exp(-iEt)) V^dagger
+for whole vectors of times without repeated expm calls.
+"""
+import numpy as np
+from numpy.linalg import eigh
+
+from cache_utils import ContentLRU, content_key
+
+_eigh_cache = ContentLRU(4)
+
+
+def cached_eigh(ham):
+    """
+    Description: eigh of a Hermitian matrix, memoized by a hash of its contents
+
+    Args: Hamiltonian matrix: ham
+
+    Returns: eigenvalues: energies; eigenvectors as columns: eigenstates
+    """
+    ham = np.ascontiguousarray(ham)
+    return _eigh_cache.get_or_build(content_key(ham), lambda: eigh(ham))
+
+
+def evolution_operators(ham, ts, project = True):
+    """
+    Description: Time evolution operators exp(-i ham t) for a vector of times from one
+    cached eigendecomposition. With project = True every operator is replaced by the
+    closest unitary (as in qcels.closest_unitary) so that qiskit accepts it as a UnitaryGate.
+
+    Args: Hamiltonian matrix: ham; vector of times: ts; project onto unitaries: project
+
+    Returns: array of shape (len(ts), N, N) with U[i] = exp(-i ham ts[i])
+    """
+    energies, eigenstates = cached_eigh(ham)
+    phases = np.exp(-1j*np.multiply.outer(np.asarray(ts, dtype=float), energies))
+    U = (eigenstates[None, :, :]*phases[:, None, :]) @ eigenstates.conj().T
+    if project:
+        V, _, Wh = np.linalg.svd(U)
+        U = V @ Wh
+    return U
+
+
+def spectral_weights(ham, init_state):
+    """
+    Description: Diagonalize the Hamiltonian and project the initial state onto its eigenbasis
+
+    Args: Hamiltonian matrix: ham;
+    initial state |phi>: init_state
+
+    Returns: eigenvalues of ham: energies; overlaps |<psi_k|phi>|^2: weights
+    """
+    energies, eigenstates = cached_eigh(ham)
+    weights = np.abs(eigenstates.conj().T @ np.asarray(init_state))**2
+    return energies, weights
+
+
+def compute_Z(ts, energies, weights):
+    """
+    Description: Exact Hadamard-test signal Z(t) = sum_k weights_k exp(-i E_k t)
+
+    Args: times of any shape: ts;
+    eigenvalues and overlaps from spectral_weights: energies, weights
+
+    Returns: Z(t) with the shape of ts
+    """
+    ts = np.asarray(ts, dtype=float)
+    Z = np.exp(-1j*np.multiply.outer(ts, energies)) @ weights
+    return Z
+
+
+def sample_Z(ts, energies, weights, shots, rng=None):
+    """
+    Description: Shot-noise estimate of Z(t) from the Re and Im Hadamard tests, each
+    measured with the given number of shots
+
+    Args: times of any shape: ts;
+    eigenvalues and overlaps from spectral_weights: energies, weights;
+    number of shots per circuit: shots;
+    random generator or seed: rng
+
+    Returns: estimates (2*re_p0-1) + 1j*(2*im_p0-1) with the shape of ts
+    """
+    rng = np.random.default_rng(rng)
+    Z = compute_Z(ts, energies, weights)
+    p_re = np.clip((1 + Z.real)/2, 0, 1)
+    p_im = np.clip((1 + Z.imag)/2, 0, 1)
+    re_p0 = rng.binomial(shots, p_re)/shots
+    im_p0 = rng.binomial(shots, p_im)/shots
+    return (2*re_p0 - 1) + 1j*(2*im_p0 - 1)
+
+
+def sample_Z_ests(energies, weights, taus, time_steps, tests, shots, rng=None):
+    """
+    Description: Build the Z_ests[test][trial][iter] nested lists of the qcels.py driver
+    for one initial state without constructing any circuits
+
+    Args: eigenvalues and overlaps from spectral_weights: energies, weights;
+    time step of every level: taus[trial][iter];
+    number of data pairs(time steps): time_steps;
+    number of repetitions: tests;
+    number of shots per circuit: shots;
+    random generator or seed: rng
+
+    Returns: nested list Z_ests[test][trial][iter][time_step] of complex estimates
+    """
+    rng = np.random.default_rng(rng)
+    max_levels = max(len(tau) for tau in taus)
+    tau_array = np.zeros((len(taus), max_levels))
+    for trial in range(len(taus)):
+        tau_array[trial, :len(taus[trial])] = taus[trial]
+    ts = np.multiply.outer(tau_array, np.arange(time_steps))
+    Z = sample_Z(np.broadcast_to(ts, (tests,) + ts.shape), energies, weights, shots, rng)
+    Z_ests = []
+    for test in range(tests):
+        Z_ests.append([])
+        for trial in range(len(taus)):
+            Z_ests[test].append([list(Z[test, trial, iter]) for iter in range(len(taus[trial]))])
+    return Z_ests
@@ -0,0 +1,94 @@
+""" Extremal eigenvalues of Hamiltonians
+
+The QCELS workflow only needs the two ends of the spectrum: the ground
+energy and ground state as the reference, and the largest eigenvalue or
+the spectral norm for rescaling. These helpers use Lanczos (ARPACK eigsh)
+for anything but tiny matrices instead of a full eigh/SVD, and provide the
+Pauli 1-norm as a cheap upper bound on the spectral norm.
+"""
+import numpy as np
+import scipy.sparse
+from numpy.linalg import eigh
+from scipy.sparse.linalg import eigsh
+from qiskit.quantum_info import SparsePauliOp
+
+dense_limit = 64 # matrices up to this dimension are diagonalized directly
+
+
+def as_matrix(H):
+    """ Dense array or scipy sparse matrix for H (a SparsePauliOp becomes CSR) """
+    if isinstance(H, SparsePauliOp):
+        return H.to_matrix(sparse=True)
+    if scipy.sparse.issparse(H):
+        return H
+    return np.asarray(H)
+
+
+def extremal_eigenpair(H, which = 'SA', return_vector = True):
+    """
+    Description: Smallest ('SA') or largest ('LA') eigenvalue of a Hermitian operator
+
+    Args: dense, sparse or SparsePauliOp Hamiltonian: H;
+    end of the spectrum: which = 'SA' ('LA');
+    also return the eigenvector: return_vector
+
+    Returns: eigenvalue (and normalized eigenvector)
+    """
+    H = as_matrix(H)
+    if H.shape[0] <= dense_limit:
+        vals, vecs = eigh(H.toarray() if scipy.sparse.issparse(H) else H)
+        k = 0 if which == 'SA' else -1
+        val, vec = vals[k], vecs[:, k]
+    elif return_vector:
+        vals, vecs = eigsh(H, k=1, which=which)
+        val, vec = vals[0], vecs[:, 0]
+    else:
+        val = eigsh(H, k=1, which=which, return_eigenvectors=False)[0]
+    if return_vector:
+        return val, vec
+    return val
+
+
+def ground_state(H):
+    """ Ground energy and ground state of H """
+    return extremal_eigenpair(H, which = 'SA')
+
+
+def largest_eigenvalue(H):
+    """ Largest eigenvalue of H """
+    return extremal_eigenpair(H, which = 'LA', return_vector = False)
+
+
+def pauli_norm_bound(H):
+    """
+    Description: Pauli 1-norm sum_j |c_j| of H = sum_j c_j P_j, an upper bound on the spectral norm
+
+    Args: SparsePauliOp, list of (label, coefficient) pairs, or a (small) dense matrix: H
+
+    Returns: the 1-norm of the Pauli coefficients
+    """
+    if isinstance(H, list):
+        H = SparsePauliOp.from_list(H)
+    if not isinstance(H, SparsePauliOp):
+        H = SparsePauliOp.from_operator(np.asarray(H))
+    return np.sum(np.abs(H.simplify().coeffs))
+
+
+def spectral_norm(H, method = 'exact'):
+    """
+    Description: Spectral norm of a Hermitian operator
+
+    Args: dense, sparse or SparsePauliOp Hamiltonian (or Pauli terms for 'pauli'): H;
+    method = 'exact' (2-norm of a dense matrix), 'lanczos' (max |extremal eigenvalue|),
+    'pauli' (Pauli 1-norm upper bound)
+
+    Returns: the norm
+    """
+    if method[0].upper() == 'P':
+        return pauli_norm_bound(H)
+    H = as_matrix(H)
+    if method[0].upper() == 'E' and not scipy.sparse.issparse(H):
+        return np.linalg.norm(H, ord=2)
+    smallest = extremal_eigenpair(H, which = 'SA', return_vector = False)
+    largest = extremal_eigenpair(H, which = 'LA', return_vector = False)
+    return max(abs(smallest), abs(largest))
@@ -0,0 +1,101 @@
+""" Exact TFIM spectrum from free fermions
+
+H = -J sum_i Z_i Z_{i+1} - g sum_i X_i (the open chain of Ham_generator, or
+the periodic chain of tfim_1d) maps by a Jordan-Wigner transformation to
+H = i sum_ij a_i M_ij b_j in Majorana operators a, b with M = g on the
+diagonal and -J on the subdiagonal. With the singular values s_k of M,
+H = sum_k s_k (2 n_k - 1), so the mode energies are 2 s_k and every
+eigenvalue costs one O(n^3) SVD instead of a 2^n x 2^n matrix.
+
+The Bogoliubov vacuum has spin-flip parity prod_i X_i = sign det(M)
+(the sign of det(U) det(V) of the SVD, which stays defined when M is
+singular). On the periodic chain the boundary bond is +-J in M[0, n-1]
+depending on the parity sector P, and only states with parity P belong
+to that sector, so the extremal eigenvalues are taken over both sectors.
+"""
+import numpy as np
+
+
+def majorana_matrix(n, J = 1, g = 1, boundary = 'open', parity = 1):
+    """
+    Description: Coupling matrix M of H = i a^T M b
+
+    Args: number of sites: n; ZZ coupling: J; transverse field: g;
+    boundary = 'open' ('periodic'); parity sector of the periodic chain: parity = 1 (-1)
+
+    Returns: n x n real matrix
+    """
+    M = g*np.eye(n) - J*np.eye(n, k = -1)
+    if boundary[0].upper() == 'P' and n > 1:
+        M[0, n-1] += parity*J
+    return M
+
+
+def _modes(M):
+    U, s, Vh = np.linalg.svd(M)
+    return s, np.sign(np.linalg.det(U)*np.linalg.det(Vh))
+
+
+def mode_energies(n, J = 1, g = 1, boundary = 'open', parity = 1):
+    """
+    Description: Single-particle (Bogoliubov) mode energies 2 s_k, in ascending order
+
+    Args: same as majorana_matrix
+
+    Returns: array of n energies
+    """
+    s, _ = _modes(majorana_matrix(n, J, g, boundary, parity))
+    return np.sort(2*s)
+
+
+def _extremal(n, J, g, boundary, sign):
+    # lowest eigenvalue of sign*H (sign = -1 gives minus the largest eigenvalue of H)
+    energies = []
+    for parity in ((1, -1) if boundary[0].upper() == 'P' else (None,)):
+        s, vacuum_parity = _modes(majorana_matrix(n, sign*J, sign*g, boundary, 1 if parity is None else parity))
+        E = -np.sum(s)
+        if parity is not None and vacuum_parity != parity:
+            # lowest state of the sector has one quasiparticle in the softest mode
+            E += 2*np.min(s)
+        energies.append(E)
+    return min(energies)
+
+
+def ground_energy(n, J = 1, g = 1, boundary = 'open'):
+    """ Ground energy of the TFIM chain """
+    return _extremal(n, J, g, boundary, 1)
+
+
+def largest_eigenvalue(n, J = 1, g = 1, boundary = 'open'):
+    """ Largest eigenvalue of the TFIM chain (used for the scaling/largest_eig normalization) """
+    return -_extremal(n, J, g, boundary, -1)
+
+
+def spectral_norm(n, J = 1, g = 1, boundary = 'open'):
+    """ Spectral norm of the TFIM chain """
+    return max(abs(ground_energy(n, J, g, boundary)), abs(largest_eigenvalue(n, J, g, boundary)))
+
+
+def spectral_gap(n, J = 1, g = 1, boundary = 'open'):
+    """
+    Description: Gap between the ground energy and the first excited level (zero for a
+    degenerate ground state)
+
+    Args: number of sites: n; ZZ coupling: J; transverse field: g; boundary = 'open' ('periodic')
+
+    Returns: E_1 - E_0
+    """
+    if boundary[0].upper() != 'P':
+        return 2*np.min(_modes(majorana_matrix(n, J, g, boundary))[0])
+    # lowest two levels of each parity sector
+    levels = []
+    for parity in (1, -1):
+        s, vacuum_parity = _modes(majorana_matrix(n, J, g, boundary, parity))
+        s = np.sort(s)
+        E0 = -np.sum(s)
+        if vacuum_parity == parity:
+            levels += [E0, E0 + 2*s[0] + 2*s[1]] if n > 1 else [E0]
+        else:
+            levels += [E0 + 2*s[0]] + ([E0 + 2*s[1]] if n > 1 else [])
+    levels = np.sort(levels)
+    return levels[1] - levels[0]
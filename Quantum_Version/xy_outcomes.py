@@ -0,0 +1,93 @@
+""" Compact storage of sampled Hadamard-test outcomes
+
+sample_XY and friends produce +-1 outcomes X, Y and Fourier indices J of
+shape (..., Nsample), e.g. (Nbatch, Nsample) or (Nbin, Nbatch, Nsample).
+XYOutcomes keeps X and Y as bits packed along the sample axis (1 for +1)
+and J in the smallest unsigned integer type that holds 2d+1 indices,
+instead of complex128 and int64 arrays. Indexing the leading axes returns
+views with the same semantics, and blocks() hands out int8 outcomes a few
+rows at a time so consumers never inflate the whole cube.
+"""
+import numpy as np
+
+
+class XYOutcomes:
+    """
+    Description: Bit-packed X/Y outcomes with compact Fourier indices
+
+    Args: packed X and Y bits of shape (..., ceil(Nsample/8)): X_bits, Y_bits;
+    indices of shape (..., Nsample): J
+    """
+
+    def __init__(self, X_bits, Y_bits, J):
+        self.X_bits = X_bits
+        self.Y_bits = Y_bits
+        self.J = J
+
+    @classmethod
+    def empty(cls, shape, n):
+        """ Container for outcomes of the given shape with n = 2d+1 possible indices """
+        packed = shape[:-1] + ((shape[-1] + 7)//8,)
+        return cls(np.zeros(packed, dtype=np.uint8), np.zeros(packed, dtype=np.uint8),
+                   np.zeros(shape, dtype=np.min_scalar_type(max(n - 1, 0))))
+
+    @classmethod
+    def from_arrays(cls, outcome_X_arr, outcome_Y_arr, J_arr, n):
+        """ Pack +-1 outcome arrays (any real or complex dtype) and their indices """
+        outcomes = cls.empty(np.shape(J_arr), n)
+        outcomes[...] = (outcome_X_arr, outcome_Y_arr, J_arr)
+        return outcomes
+
+    @property
+    def shape(self):
+        return self.J.shape
+
+    @property
+    def nbytes(self):
+        return self.X_bits.nbytes + self.Y_bits.nbytes + self.J.nbytes
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        # index the leading (non-sample) axes
+        return XYOutcomes(self.X_bits[index], self.Y_bits[index], self.J[index])
+
+    def __setitem__(self, index, value):
+        # value is an XYOutcomes or an (outcome_X, outcome_Y, J) tuple
+        if isinstance(value, XYOutcomes):
+            self.X_bits[index] = value.X_bits
+            self.Y_bits[index] = value.Y_bits
+            self.J[index] = value.J
+        else:
+            outcome_X, outcome_Y, J = value
+            self.X_bits[index] = np.packbits(np.real(outcome_X) > 0, axis=-1)
+            self.Y_bits[index] = np.packbits(np.real(outcome_Y) > 0, axis=-1)
+            self.J[index] = J
+
+    def _unpack(self, bits):
+        return 2*np.unpackbits(bits, axis=-1, count=self.shape[-1]).astype(np.int8) - 1
+
+    def X(self):
+        return self._unpack(self.X_bits)
+
+    def Y(self):
+        return self._unpack(self.Y_bits)
+
+    def as_arrays(self):
+        """ The legacy (complex128 X, complex128 Y, int J) arrays """
+        return self.X().astype(np.complex128), self.Y().astype(np.complex128), self.J.astype(int)
+
+    def blocks(self, chunk_size=2**22):
+        """
+        Description: Flattened (J, X, Y) blocks of whole rows with about chunk_size samples each
+
+        Returns: generator of (J, int8 X, int8 Y) one-dimensional arrays
+        """
+        Nsample = self.shape[-1]
+        rows = XYOutcomes(self.X_bits.reshape(-1, self.X_bits.shape[-1]),
+                          self.Y_bits.reshape(-1, self.Y_bits.shape[-1]), self.J.reshape(-1, Nsample))
+        step = max(1, chunk_size//max(Nsample, 1))
+        for start in range(0, rows.shape[0], step):
+            block = rows[start:start+step]
+            yield block.J.ravel(), block.X().ravel(), block.Y().ravel()